@@ -19,41 +19,305 @@ import gtk
 import glib
 import math
 import sys
+import os
+import time
+import hashlib
 import mapping
 import traceback
+import gwc
+try:
+	import numpy
+except ImportError:
+	numpy = None
+try:
+	import cairo
+except ImportError:
+	cairo = None
 
 metersperdegree = 1852. * 60
 
 def deg (pos):
 	return ['%d°%f' % (int (pos[i]), (pos[i] - int (pos[i])) * 60) for i in range (2)]
 
+def clip (x0, y0, x1, y1, box):
+	'''Clip the line from (x0, y0) to (x1, y1) to box (xmin, ymin, xmax, ymax), using the Liang-Barsky algorithm.
+	Return the visible part as (x0, y0, x1, y1), or None if the line is completely outside the box.'''
+	dx = float (x1 - x0)
+	dy = float (y1 - y0)
+	t0, t1 = 0., 1.
+	for p, q in ((-dx, x0 - box[0]), (dx, box[2] - x0), (-dy, y0 - box[1]), (dy, box[3] - y0)):
+		if p == 0:
+			# Parallel to this edge.
+			if q < 0:
+				return None
+			continue
+		r = q / p
+		if p < 0:
+			if r > t1:
+				return None
+			if r > t0:
+				t0 = r
+		else:
+			if r < t0:
+				return None
+			if r < t1:
+				t1 = r
+	return (x0 + t0 * dx, y0 + t0 * dy, x0 + t1 * dx, y0 + t1 * dy)
+
+def simplify (points, tolerance, scale = 1.):
+	'''Simplify a line through points (lat, lon) with the Douglas-Peucker algorithm.
+	tolerance is in degrees latitude; longitudes are multiplied by scale (the cosine of the latitude) first.
+	The first and last points are always kept.'''
+	if len (points) < 3:
+		return list (points)
+	keep = [False] * len (points)
+	keep[0] = keep[-1] = True
+	limit = tolerance ** 2
+	todo = [(0, len (points) - 1)]
+	while todo:
+		first, last = todo.pop ()
+		ay, ax = points[first][0], points[first][1] * scale
+		dy, dx = points[last][0] - ay, points[last][1] * scale - ax
+		length = dx ** 2 + dy ** 2
+		worst, found = limit, None
+		for i in range (first + 1, last):
+			py, px = points[i][0] - ay, points[i][1] * scale - ax
+			if length == 0:
+				# For closed polygons, use the distance to the first point.
+				d = px ** 2 + py ** 2
+			else:
+				d = (dx * py - dy * px) ** 2 / length
+			if d > worst:
+				worst, found = d, i
+		if found is not None:
+			keep[found] = True
+			todo += ((first, found), (found, last))
+	return [p for p, k in zip (points, keep) if k]
+
+def clip_lines (points, box):
+	'''Clip a line through points (x, y) to box (xmin, ymin, xmax, ymax).
+	Return the visible parts, each as a list of integer points which can be passed to draw_lines.'''
+	ret = []
+	run = None
+	for i in range (len (points) - 1):
+		a = points[i]
+		b = points[i + 1]
+		s = clip (a[0], a[1], b[0], b[1], box)
+		if s is None:
+			run = None
+			continue
+		if run is None or (s[0], s[1]) != (a[0], a[1]):
+			run = [(int (s[0]), int (s[1]))]
+			ret.append (run)
+		run.append ((int (s[2]), int (s[3])))
+		if (s[2], s[3]) != (b[0], b[1]):
+			run = None
+	return ret
+
+class Styles:
+	'''GCs for drawing, shared by all layers and maps.  There is one GC for every style
+	(foreground, background, line width, (double dash, dashes), round caps), and every color is allocated once.'''
+	def __init__ (self):
+		self.gcs = {}
+		self.keys = {}
+		self.colors = {}
+		self.allocated = {}
+		self.requests = 0
+	def color (self, name):
+		if name not in self.allocated:
+			self.allocated[name] = gtk.gdk.colormap_get_system ().alloc_color (name)
+		return self.allocated[name]
+	def rgb (self, name):
+		'''Get a color as (red, green, blue) in the range 0 to 1.  This does not need a display.'''
+		if name not in self.colors:
+			c = gtk.gdk.color_parse (name)
+			self.colors[name] = (c.red / 65535., c.green / 65535., c.blue / 65535.)
+		return self.colors[name]
+	def get (self, window, fg, bg = None, lw = 1, dash = (False, ()), round = True):
+		'''Get the GC for a style.  It must not be changed, except for temporary clipping.
+		If window is None, there is no display; the style is returned and can only be used with CairoRenderer.'''
+		self.requests += 1
+		key = (fg, bg, lw, bool (dash[0]), tuple (dash[1]), round)
+		if window is None:
+			self.keys[key] = key
+			return key
+		gc = self.gcs.get (key)
+		if gc is not None:
+			return gc
+		gc = gtk.gdk.GC (window)
+		gc.set_foreground (self.color (fg))
+		if bg is not None:
+			gc.set_background (self.color (bg))
+		if len (dash[1]) > 0:
+			gc.set_dashes (0, dash[1])
+		if round:
+			cap, join = gtk.gdk.CAP_ROUND, gtk.gdk.JOIN_ROUND
+		else:
+			cap, join = gtk.gdk.CAP_BUTT, gtk.gdk.JOIN_BEVEL
+		if len (dash[1]) == 0:
+			gc.set_line_attributes (lw, gtk.gdk.LINE_SOLID, gtk.gdk.CAP_BUTT, gtk.gdk.JOIN_BEVEL)
+		elif dash[0]:
+			gc.set_line_attributes (lw, gtk.gdk.LINE_DOUBLE_DASH, cap, join)
+		else:
+			gc.set_line_attributes (lw, gtk.gdk.LINE_ON_OFF_DASH, cap, join)
+		gc.set_fill (gtk.gdk.SOLID)
+		self.gcs[key] = gc
+		self.keys[gc] = key
+		return gc
+	def stats (self):
+		return {'styles': len (set (self.keys.values ())), 'colors': len (self.allocated), 'requests': self.requests, 'hits': self.requests - len (set (self.keys.values ()))}
+
+# The styles which are used for all maps.
+styles = Styles ()
+
+class GdkRenderer:
+	'''Draw directly on a GDK drawable, one request per primitive.
+	Renderers are made for one frame; layers draw through self.map.renderer and the map calls flush when they are done.'''
+	def __init__ (self, target, area = None, ordered = False):
+		self.target = target
+	def line (self, gc, x0, y0, x1, y1):
+		self.target.draw_line (gc, x0, y0, x1, y1)
+	def lines (self, gc, points):
+		self.target.draw_lines (gc, points)
+	def polygon (self, gc, filled, points):
+		self.target.draw_polygon (gc, filled, points)
+	def ellipse (self, gc, x, y, width, height):
+		self.target.draw_arc (gc, False, x, y, width, height, 0, 64 * 360)
+	def drawable (self, gc, src, x, y, width, height):
+		'''Copy an image.  This is done immediately by all renderers, so it should be drawn before anything else.'''
+		self.target.draw_drawable (gc, src, 0, 0, x, y, width, height)
+	def flush (self):
+		pass
+
+class CairoRenderer (GdkRenderer):
+	'''Collect primitives and draw them antialiased with cairo when the frame is flushed, with one path for every style.
+	If ordered is True, only consecutive primitives with the same style are combined, so the drawing order is kept.
+	Styles come from the GCs, which must have been made by styles.'''
+	def __init__ (self, target, area = None, ordered = False):
+		self.target = target
+		self.area = area
+		self.ordered = ordered
+		self.batches = []	# List of (gc, filled, primitives).
+		self.index = {}	# (gc, filled) -> primitives, if not ordered.
+	def _batch (self, gc, filled):
+		if self.ordered:
+			if len (self.batches) > 0 and self.batches[-1][:2] == (gc, filled):
+				return self.batches[-1][2]
+		elif (gc, filled) in self.index:
+			return self.index[(gc, filled)]
+		ret = []
+		self.batches.append ((gc, filled, ret))
+		if not self.ordered:
+			self.index[(gc, filled)] = ret
+		return ret
+	def line (self, gc, x0, y0, x1, y1):
+		self._batch (gc, False).append ((False, ((x0, y0), (x1, y1))))
+	def lines (self, gc, points):
+		if len (points) > 1:
+			self._batch (gc, False).append ((False, points))
+	def polygon (self, gc, filled, points):
+		if len (points) > 1:
+			self._batch (gc, filled).append ((False, list (points) + [points[0]]))
+	def ellipse (self, gc, x, y, width, height):
+		if width > 0 and height > 0:
+			self._batch (gc, False).append ((True, (x, y, width, height)))
+	def flush (self):
+		if len (self.batches) == 0:
+			return
+		if hasattr (self.target, 'cairo_create'):
+			cr = self.target.cairo_create ()
+		else:
+			# A cairo surface.
+			cr = cairo.Context (self.target)
+		if self.area is not None:
+			cr.rectangle (*self.area)
+			cr.clip ()
+		for gc, filled, primitives in self.batches:
+			fg, bg, lw, double, dashes, round = styles.keys.get (gc, ('black', None, 1, False, (), False))
+			lw = max (lw, 1)
+			if len (dashes) > 0 and round:
+				cr.set_line_cap (cairo.LINE_CAP_ROUND)
+				cr.set_line_join (cairo.LINE_JOIN_ROUND)
+			else:
+				cr.set_line_cap (cairo.LINE_CAP_BUTT)
+				cr.set_line_join (cairo.LINE_JOIN_BEVEL)
+			cr.set_line_width (lw)
+			# Put lines with an odd width in the middle of the pixels, like GDK does.
+			offset = .5 if not filled and lw % 2 == 1 else 0
+			cr.new_path ()
+			for is_ellipse, p in primitives:
+				if is_ellipse:
+					cr.save ()
+					cr.translate (p[0] + p[2] / 2. + offset, p[1] + p[3] / 2. + offset)
+					cr.scale (p[2] / 2., p[3] / 2.)
+					cr.new_sub_path ()
+					cr.arc (0, 0, 1, 0, 2 * math.pi)
+					cr.restore ()
+				else:
+					cr.move_to (p[0][0] + offset, p[0][1] + offset)
+					for point in p[1:]:
+						cr.line_to (point[0] + offset, point[1] + offset)
+			if filled:
+				self._source (cr, fg)
+				cr.fill ()
+				continue
+			if double and bg is not None:
+				# The gaps of double dashed lines are drawn in the background color.
+				cr.set_dash ([])
+				self._source (cr, bg)
+				cr.stroke_preserve ()
+			cr.set_dash (list (dashes))
+			self._source (cr, fg)
+			cr.stroke ()
+		self.batches = []
+		self.index = {}
+	def _source (self, cr, name):
+		cr.set_source_rgb (*styles.rgb (name))
+
+# Available renderers, by name.
+renderers = {'gdk': GdkRenderer}
+if cairo is not None:
+	renderers['cairo'] = CairoRenderer
+
 class Layer:
 	'''Base class for layers. Implementations must define draw(self, pos) to update the contents.
-	Drawing must be done on self.map.buffer.'''
+	Drawing must be done through self.map.renderer.
+	Static layers are drawn into a cached image, which is only redrawn when the zoom or size changes,
+	or when dirty is set on one of them.  When panning, the cache is shifted and only the exposed part is drawn.
+	Layers which change all the time should set static to False; they are drawn on top of the cache for every update.
+	Parts of a static layer which depend on the view, not only on the map, must be drawn by draw_overlay, which is called for every update.'''
+	static = True
 	def __init__ (self, map, color):
 		self.map = map
 		self.color = color
+		self.dirty = True
+	def changed (self):
+		'''Redraw the layer after its contents have changed.'''
+		self.dirty = True
+		self.map.update ()
+	def draw_overlay (self):
+		'''Draw the parts of the layer which are not cached.  Can be overridden.'''
+		pass
+	def gcs (self):
+		'''All GCs used for drawing; they are clipped when drawing part of the cache.'''
+		return getattr (self, 'gc', [])
 	def _realize (self, window):
-		self.gc = [gtk.gdk.GC (window) for t in range (4)]
-		c = gtk.gdk.colormap_get_system ().alloc_color (self.color)
-		for t in range (4):
-			self.gc[t].set_foreground (c)
-			self.gc[t].set_dashes (0, (1, 2))
-		self.gc[0].set_line_attributes (1, gtk.gdk.LINE_SOLID, gtk.gdk.CAP_BUTT, gtk.gdk.JOIN_BEVEL)
-		self.gc[1].set_line_attributes (1, gtk.gdk.LINE_ON_OFF_DASH, gtk.gdk.CAP_BUTT, gtk.gdk.JOIN_BEVEL)
-		self.gc[2].set_line_attributes (2, gtk.gdk.LINE_SOLID, gtk.gdk.CAP_BUTT, gtk.gdk.JOIN_BEVEL)
-		self.gc[3].set_line_attributes (2, gtk.gdk.LINE_ON_OFF_DASH, gtk.gdk.CAP_BUTT, gtk.gdk.JOIN_BEVEL)
+		# Thin and thick, solid and dashed.
+		self.gc = [styles.get (window, self.color, None, lw, (False, dashes), False) for lw in (1, 2) for dashes in ((), (1, 2))]
+	def on_screen (self, pos):
+		p = self.map.pixel (pos)
+		return 0 <= p[0] < self.map.size[0] and 0 <= p[1] < self.map.size[1]
 	def draw_marker (self, pos, details):
 		p = self.map.pixel (pos)
 		gc = self.gc[2 * details[0] + (not details[1])]
 		if 0 <= p[0] < self.map.size[0] and 0 <= p[1] < self.map.size[1]:
 			#print ('drawing marker at %s = %s' % (','.join (deg (pos)), str (p)))
-			self.map.buffer.draw_line (gc, p[0], p[1] - p[3] + 5, p[0], p[1] - p[3] - 5)
-			self.map.buffer.draw_line (gc, p[0], p[1] + p[3] - 5, p[0], p[1] + p[3] + 5)
-			self.map.buffer.draw_line (gc, p[0] - p[2] + 5, p[1], p[0] - p[2] - 5, p[1])
-			self.map.buffer.draw_line (gc, p[0] + p[2] - 5, p[1], p[0] + p[2] + 5, p[1])
+			self.map.renderer.line (gc, p[0], p[1] - p[3] + 5, p[0], p[1] - p[3] - 5)
+			self.map.renderer.line (gc, p[0], p[1] + p[3] - 5, p[0], p[1] + p[3] + 5)
+			self.map.renderer.line (gc, p[0] - p[2] + 5, p[1], p[0] - p[2] - 5, p[1])
+			self.map.renderer.line (gc, p[0] + p[2] - 5, p[1], p[0] + p[2] + 5, p[1])
 			if details[0] and p[2] is not None and p[3] is not None:
-				self.map.buffer.draw_arc (gc, False, p[0] - p[2], p[1] - p[3], p[2] * 2, p[3] * 2, 0, 64 * 360)
+				self.map.renderer.ellipse (gc, p[0] - p[2], p[1] - p[3], p[2] * 2, p[3] * 2)
 		else:
 			p = [float (x) for x in p]
 			center = [float (x) for x in self.map.pixel (self.map.pos)]
@@ -94,12 +358,12 @@ class Layer:
 			dist = math.sqrt (sum ([delta[t] ** 2 for t in range (2)]))
 			unit = [delta[t] / dist for t in range (2)]
 			if details[0]:
-				self.map.buffer.draw_line (gc, int (intersection[0] - 20 * unit[0]), int (intersection[1] - 20 * unit[1]), int (intersection[0] - 5 * unit[0]), int (intersection[1] - 5 * unit[1]))
-				self.map.buffer.draw_line (gc, int (intersection[0] - 5 * unit[0] + 5 * unit[1]), int (intersection[1] - 5 * unit[1] - 5 * unit[0]), int (intersection[0]), int (intersection[1]))
-				self.map.buffer.draw_line (gc, int (intersection[0] - 5 * unit[0] - 5 * unit[1]), int (intersection[1] - 5 * unit[1] + 5 * unit[0]), int (intersection[0]), int (intersection[1]))
-				self.map.buffer.draw_line (gc, int (intersection[0] - 5 * unit[0] + 5 * unit[1]), int (intersection[1] - 5 * unit[1] - 5 * unit[0]), int (intersection[0] - 5 * unit[0] - 5 * unit[1]), int (intersection[1] - 5 * unit[1] + 5 * unit[0]))
+				self.map.renderer.line (gc, int (intersection[0] - 20 * unit[0]), int (intersection[1] - 20 * unit[1]), int (intersection[0] - 5 * unit[0]), int (intersection[1] - 5 * unit[1]))
+				self.map.renderer.line (gc, int (intersection[0] - 5 * unit[0] + 5 * unit[1]), int (intersection[1] - 5 * unit[1] - 5 * unit[0]), int (intersection[0]), int (intersection[1]))
+				self.map.renderer.line (gc, int (intersection[0] - 5 * unit[0] - 5 * unit[1]), int (intersection[1] - 5 * unit[1] + 5 * unit[0]), int (intersection[0]), int (intersection[1]))
+				self.map.renderer.line (gc, int (intersection[0] - 5 * unit[0] + 5 * unit[1]), int (intersection[1] - 5 * unit[1] - 5 * unit[0]), int (intersection[0] - 5 * unit[0] - 5 * unit[1]), int (intersection[1] - 5 * unit[1] + 5 * unit[0]))
 			else:
-				self.map.buffer.draw_line (gc, int (intersection[0] - 10 * unit[0]), int (intersection[1] - 10 * unit[1]), int (intersection[0]), int (intersection[1]))
+				self.map.renderer.line (gc, int (intersection[0] - 10 * unit[0]), int (intersection[1] - 10 * unit[1]), int (intersection[0]), int (intersection[1]))
 	def intersect_top (self, p, center):
 		'Prevent division by zero: swap x and y.'
 		a = (p[0] - center[0]) / (p[1] - center[1])
@@ -113,34 +377,24 @@ class Layer:
 	def boundingbox (self, box):
 		return box
 
-class Map (gtk.DrawingArea):
-	def __init__ (self, lat, lon):
-		gtk.DrawingArea.__init__ (self)
-		self.force_position = None
-		self.size = None
-		self.buffer = None
-		self.update_handle = None
-		self.connect_after ('realize', self.realize)
-		self.connect ('expose-event', self.expose)
-		self.connect ('configure-event', self.configure)
-		self.connect ('button-press-event', self.button_press)
-		self.connect ('scroll-event', self.scroll)
-		self.connect ('key-press-event', self.key_press)
-		self.connect ('motion-notify-event', self.motion)
+class View (object):
+	'''Position, zoom and layers of a map, without a widget.
+	It can be drawn on anything the renderer can draw on, for example a cairo surface with CairoRenderer,
+	which does not need a display.  Map is a View in a widget.'''
+	def __init__ (self, lat, lon, size = None, zoom = None, renderer = 'gdk'):
 		self.pos = (lat, lon)
-		self.zoom = None
+		self.size = size
+		self.zoom = None if zoom is None else float (zoom)
 		self.layers = []
 		self.positionlayer = None
-		self.buffer = None
-		self.gc = None
-		self.set_can_focus (True)
-		self.add_events (gtk.gdk.EXPOSURE_MASK | gtk.gdk.STRUCTURE_MASK | gtk.gdk.BUTTON_PRESS_MASK | gtk.gdk.SCROLL_MASK | gtk.gdk.KEY_PRESS_MASK | gtk.gdk.BUTTON2_MOTION_MASK)
+		self.renderer_name = renderer
+		self.renderer_class = renderers[renderer]
+		self.renderer = None
+		self._factor_key = None
 	def add_layer (self, layer):
 		self.layers += (layer,)
-		w = self.get_window ()
-		if w:
-			layer._realize (w)
-		self.update ()
+		# There is no window; layers get style keys instead of GCs.
+		layer._realize (None)
 		return layer
 	def set_pos (self, pos):
 		self.pos = pos
@@ -148,18 +402,83 @@ class Map (gtk.DrawingArea):
 	def set_zoom (self, zoom):
 		self.zoom = float (zoom)
 		self.update ()
-	def pixel (self, pos):
-		'''Convert a position (lat, long, elat, elon) to a pixel (x, y, ex, ey).'''
-		if len (pos) == 2:
-			pos = (pos[0], pos[1], None, None)
+	def set_renderer (self, name):
+		'''Select a renderer from renderers.'''
+		self.renderer_name = name
+		self.renderer_class = renderers[name]
+		self.update ()
+	def update (self):
+		'''Called when the view has changed.  Widgets redraw themselves here.'''
+		pass
+	def draw_layers (self, target, area = None, static = None):
+		'''Draw the layers on target, limited to area (x, y, width, height) if it is given.
+		If static is True or False, only the layers with that value of static are drawn;
+		the overlays of all layers are drawn with the layers which are not static.'''
+		self.renderer = self.renderer_class (target, area)
+		for l in self.layers:
+			if static is None or l.static == static:
+				l.draw ()
+			if static is not True:
+				l.draw_overlay ()
+		self.renderer.flush ()
+	def fit (self):
+		'''Move and zoom so that everything on all layers is visible.  Return False if there is nothing to show.'''
+		box = None
+		for l in self.layers:
+			box = l.boundingbox (box)
+		if box is None:
+			return False
+		self.pos = ((box[0] + box[2]) / 2., (box[1] + box[3]) / 2.)
+		size = (box[2] - box[0], box[3] - box[1])
+		if size[0] == 0:
+			size = (.00001, size[1])
+		if size[1] == 0:
+			size = (size[0], .00001)
+		zoomlat = self.size[1] / size[0]
+		zoomlon = self.size[0] / (size[1] * math.cos (math.radians (self.pos[0])))
+		self.zoom = min (zoomlat, zoomlon) * 0.95
+		return True
+	def _factors (self):
+		'''Get (center x, center y, pixels per degree latitude, pixels per degree longitude).
+		They are only recomputed when the view has changed.'''
 		#self.pos is the center of the image.
 		#self.zoom is the number of pixels per longitudinal degree.
 		# longitudinal number of pixels per degree is the value for the latitude of pos, it is used for the entire image.
 		# in y direction, the zoom is negative so higher numbers are at the top of the screen. The y direction is the latitude.
-		zoom = (-self.zoom, self.zoom * math.cos (math.radians (self.pos[0])))
-		fromcenter = [pos[i] - self.pos[i] for i in range (2)]
+		key = (self.pos[0], self.pos[1], self.zoom, self.size)
+		if key != self._factor_key:
+			self._factor_key = key
+			self._factor = (self.size[0] / 2., self.size[1] / 2., -self.zoom, self.zoom * math.cos (math.radians (self.pos[0])))
+		return self._factor
+	def pixel (self, pos):
+		'''Convert a position (lat, long, elat, elon) to a pixel (x, y, ex, ey).'''
+		if len (pos) == 2:
+			pos = (pos[0], pos[1], None, None)
+		cx, cy, zlat, zlon = self._factors ()
 		# Note that x and y are reversed.
-		return [int (self.size[i] / 2. + fromcenter[1 - i] * zoom[1 - i]) for i in range (2)] + [10 if pos[i + 2] is None else abs (int (pos[3 - i] / metersperdegree * self.zoom)) for i in range (2)]
+		return [int (cx + (pos[1] - self.pos[1]) * zlon), int (cy + (pos[0] - self.pos[0]) * zlat)] + [10 if pos[i + 2] is None else abs (int (pos[3 - i] / metersperdegree * self.zoom)) for i in range (2)]
+	def pixels (self, positions, rounded = True):
+		'''Convert a sequence of positions (lat, lon) to a list of pixels (x, y), which can be passed to draw_lines.
+		If rounded is False, the pixels are not converted to integers, which is useful for clipping.
+		If numpy is available, all points are converted at once.'''
+		cx, cy, zlat, zlon = self._factors ()
+		if numpy is None or len (positions) == 0:
+			if not rounded:
+				return [(cx + (p[1] - self.pos[1]) * zlon, cy + (p[0] - self.pos[0]) * zlat) for p in positions]
+			return [(int (cx + (p[1] - self.pos[1]) * zlon), int (cy + (p[0] - self.pos[0]) * zlat)) for p in positions]
+		a = numpy.asarray (positions, dtype = float)
+		x = cx + (a[:, 1] - self.pos[1]) * zlon
+		y = cy + (a[:, 0] - self.pos[0]) * zlat
+		if rounded:
+			x = x.astype (int)
+			y = y.astype (int)
+		return zip (x.tolist (), y.tolist ())
+	def viewbox (self):
+		'''Get the visible area as (minlat, minlon, maxlat, maxlon).'''
+		cx, cy, zlat, zlon = self._factors ()
+		dlat = cy / -zlat
+		dlon = cx / zlon
+		return (self.pos[0] - dlat, self.pos[1] - dlon, self.pos[0] + dlat, self.pos[1] + dlon)
 	def fix (self, pos):
 		# Convert a position to a proper value.
 		pos = list (pos)
@@ -173,9 +492,38 @@ class Map (gtk.DrawingArea):
 		return pos
 	def position (self, pixel):
 		'''Convert a pixel (x, y, ex, ey) to a position (lat, lon, elat, elon).'''
-		zoom = (-self.zoom, self.zoom * math.cos (math.radians (self.pos[0])))
-		fromcenter = [pixel[i] - self.size[i] / 2. for i in range (2)]
-		return self.fix ([self.pos[i] + fromcenter[1 - i] / zoom[i] for i in range (2)]) + [None, None]
+		cx, cy, zlat, zlon = self._factors ()
+		return self.fix ([self.pos[0] + (pixel[1] - cy) / zlat, self.pos[1] + (pixel[0] - cx) / zlon]) + [None, None]
+
+class Map (gtk.DrawingArea, View):
+	def __init__ (self, lat, lon, renderer = 'gdk'):
+		gtk.DrawingArea.__init__ (self)
+		View.__init__ (self, lat, lon, renderer = renderer)
+		self.force_position = None
+		self.buffer = None
+		self.update_handle = None
+		self.connect_after ('realize', self.realize)
+		self.connect ('expose-event', self.expose)
+		self.connect ('configure-event', self.configure)
+		self.connect ('button-press-event', self.button_press)
+		self.connect ('scroll-event', self.scroll)
+		self.connect ('key-press-event', self.key_press)
+		self.connect ('motion-notify-event', self.motion)
+		self.gc = None
+		self.cache = None
+		self._cache_view = None
+		self.set_can_focus (True)
+		self.add_events (gtk.gdk.EXPOSURE_MASK | gtk.gdk.STRUCTURE_MASK | gtk.gdk.BUTTON_PRESS_MASK | gtk.gdk.SCROLL_MASK | gtk.gdk.KEY_PRESS_MASK | gtk.gdk.BUTTON2_MOTION_MASK)
+	def add_layer (self, layer):
+		self.layers += (layer,)
+		w = self.get_window ()
+		if w:
+			layer._realize (w)
+		self.update ()
+		return layer
+	def set_renderer (self, name):
+		self._cache_view = None
+		View.set_renderer (self, name)
 	def update (self):
 		if self.update_handle is None:
 			self.update_handle = glib.idle_add (self.do_update)
@@ -186,15 +534,64 @@ class Map (gtk.DrawingArea):
 		if not w or not self.buffer or not self.gc:
 			return False
 		self.pos = self.fix (self.pos)
-		# Clear buffer.
-		self.buffer.draw_rectangle (self.bggc, True, 0, 0, self.size[0], self.size[1])
 		if not self.pos or not self.zoom:
+			# Clear buffer.
+			self.buffer.draw_rectangle (self.bggc, True, 0, 0, self.size[0], self.size[1])
 			self.get_window ().draw_drawable (self.gc, self.buffer, 0, 0, 0, 0, self.size[0], self.size[1])
 			return False
-		for layer in self.layers:
-			layer.draw ()
+		self.update_cache ()
+		self.buffer.draw_drawable (self.gc, self.cache, 0, 0, 0, 0, self.size[0], self.size[1])
+		self.draw_layers (self.buffer, None, False)
 		w.draw_drawable (self.gc, self.buffer, 0, 0, 0, 0, self.size[0], self.size[1])
 		return False
+	def update_cache (self):
+		'''Make sure self.cache shows the static layers for the current view.'''
+		cx, cy, zlat, zlon = self._factors ()
+		view = self._cache_view
+		if view is not None and view[1:3] == (self.zoom, self.size) and not any (l.dirty for l in self.layers if l.static):
+			# Only the position may have changed.  Compute the offset of the cached image.
+			dx = int (round ((view[0][1] - self.pos[1]) * zlon))
+			dy = int (round ((view[0][0] - self.pos[0]) * zlat))
+			# When moving north or south, the longitudinal scale changes.  Allow up to half a pixel at the edges.
+			if abs (zlon / view[3] - 1) * cx < .5 and abs (dx) < self.size[0] and abs (dy) < self.size[1]:
+				if dx != 0 or dy != 0:
+					# Move to a whole number of pixels from the cached image, so it fits exactly.
+					self.pos = (view[0][0] - dy / zlat, view[0][1] - dx / zlon)
+					self._cache_view = (self.pos,) + view[1:]
+					self.shift_cache (dx, dy)
+				return
+		self._cache_view = (self.pos, self.zoom, self.size, zlon)
+		self.render_cache ((0, 0, self.size[0], self.size[1]))
+		for l in self.layers:
+			l.dirty = False
+	def shift_cache (self, dx, dy):
+		'''Move the contents of the cache by (dx, dy) pixels and draw the parts that were exposed.'''
+		w, h = self.size
+		self.cache.draw_drawable (self.gc, self.cache, max (0, -dx), max (0, -dy), max (0, dx), max (0, dy), w - abs (dx), h - abs (dy))
+		if dx > 0:
+			self.render_cache ((0, 0, dx, h))
+		elif dx < 0:
+			self.render_cache ((w + dx, 0, -dx, h))
+		if dy > 0:
+			self.render_cache ((0, 0, w, dy))
+		elif dy < 0:
+			self.render_cache ((0, h + dy, w, -dy))
+	def render_cache (self, area):
+		'''Draw the static layers in area (x, y, width, height) of the cache.'''
+		self.cache.draw_rectangle (self.bggc, True, area[0], area[1], area[2], area[3])
+		full = area == (0, 0, self.size[0], self.size[1])
+		layers = [l for l in self.layers if l.static]
+		if not full:
+			gcs = set (gc for l in layers for gc in l.gcs ())
+			for gc in gcs:
+				gc.set_clip_rectangle (gtk.gdk.Rectangle (*area))
+		try:
+			self.draw_layers (self.cache, None if full else area, True)
+		finally:
+			if not full:
+				# GCs are shared with other maps, so don't limit them to the size of this one.
+				for gc in gcs:
+					gc.set_clip_rectangle (gtk.gdk.Rectangle (0, 0, 0x7fff, 0x7fff))
 	def realize (self, widget):
 		gtk.DrawingArea.realize (self)
 		self.gc = gtk.gdk.GC (self.get_window ())
@@ -211,6 +608,8 @@ class Map (gtk.DrawingArea):
 		x, y, width, height = widget.get_allocation()
 		self.size = width, height
 		self.buffer = gtk.gdk.Pixmap (self.get_window (), width, height)
+		self.cache = gtk.gdk.Pixmap (self.get_window (), width, height)
+		self._cache_view = None
 		self.update ()
 	def do_zoom (self, factor, x, y):
 		spot = self.position ((x, y))
@@ -287,19 +686,7 @@ class Map (gtk.DrawingArea):
 			self.force_position = self.pos
 		elif event.keyval == gtk.keysyms.Home and event.state & gtk.gdk.CONTROL_MASK:
 			# Fit everything to screen.
-			box = None
-			for l in self.layers:
-				box = l.boundingbox (box)
-			self.pos = ((box[0] + box[2]) / 2., (box[1] + box[3]) / 2.)
-			size = (box[2] - box[0], box[3] - box[1])
-			if size[0] == 0:
-				size = (.00001, size[1])
-			if size[1] == 0:
-				size = (size[0], .00001)
-			pixels = self.get_window ().get_size ()
-			zoomlat = pixels[1] / size[0]
-			zoomlon = pixels[0] / (size[1] * math.cos (math.radians (self.pos[0])))
-			self.zoom = min (zoomlat, zoomlon) * 0.95
+			self.fit ()
 		elif event.keyval == gtk.keysyms.Home:
 			# Move view to current location.
 			if self.positionlayer and len (self.positionlayer.markers) > 0:
@@ -308,45 +695,234 @@ class Map (gtk.DrawingArea):
 		return True
 
 class MapLayer (Layer):
-	'''A layer showing a map'''
-	def __init__ (self, map, name):
+	'''A layer showing a map.
+	The map is drawn in tiles, which are kept in memory and in a cache directory.
+	Tiles which are in neither are rendered from the map data when the program is idle.
+	Map data is requested for blocks of tiles, and the results are cached as well.
+	Tiles are stored below cachedir in a directory for each version of the map file and renderer.
+	When they use more than disk bytes, the ones which were used least recently are removed.'''
+	tilesize = 256
+	blocksize = 4	# Number of tiles in the width and height of a query.
+	maxways = 3000	# Maximum number of ways in a query, per tile.
+	def __init__ (self, map, name, cachedir = None, memory = 16 << 20, disk = 256 << 20):
 		Layer.__init__ (self, map, 'black')
 		self.mapname = name
 		self.mapping = None
+		self.tiles = gwc.ResourceCache (memory)
+		self.queries = gwc.ResourceCache (memory / 2)
+		if cachedir is None:
+			cachedir = os.path.join (glib.get_user_cache_dir (), 'xmarksthespot', 'tiles')
+		self.cachedir = cachedir
+		# Use a new directory when the map file changes.
+		try:
+			st = os.stat (name)
+			self.cachekey = '%s %d %d' % (os.path.abspath (name), st.st_mtime, st.st_size)
+		except OSError:
+			self.cachekey = name
+		self.disk = disk
+		# Bytes written since the cache directory was last pruned; start with a check.
+		self._written = disk
+		self.queue = []
+		self.visible = set ()
+		self.render_handle = None
+		self._last = None
 	def _realize (self, window):
 		self.window = window
+		if window is not None:
+			self.tilegc = gtk.gdk.GC (window)
+			self.bggc = gtk.gdk.GC (window)
+			self.bggc.set_foreground (gtk.gdk.colormap_get_system ().alloc_color ('white'))
 		self.mapping = mapping.Map (self.mapname, self.rules)
+		self.changed ()
+	def gcs (self):
+		# The rules are used for drawing on tiles, only copying tiles to the map must be clipped.
+		return [self.tilegc] if self.window is not None else []
 	def rules (self, fg, bg, lw, dash):
-		gc = gtk.gdk.GC (self.window)
-		gc.set_foreground (gtk.gdk.colormap_get_system ().alloc_color (fg))
-		gc.set_background (gtk.gdk.colormap_get_system ().alloc_color (bg))
-		if len (dash[1]) > 0:
-			gc.set_dashes (0, dash[1])
-		if len (dash[1]) == 0:
-			gc.set_line_attributes (lw, gtk.gdk.LINE_SOLID, gtk.gdk.CAP_BUTT, gtk.gdk.JOIN_BEVEL)
-		elif dash[0]:
-			gc.set_line_attributes (lw, gtk.gdk.LINE_DOUBLE_DASH, gtk.gdk.CAP_ROUND, gtk.gdk.JOIN_ROUND)
-		else:
-			gc.set_line_attributes (lw, gtk.gdk.LINE_ON_OFF_DASH, gtk.gdk.CAP_ROUND, gtk.gdk.JOIN_ROUND)
-		gc.set_fill (gtk.gdk.SOLID)
-		return gc
+		return styles.get (self.window, fg, bg, lw, dash)
+	def _level (self, zoom):
+		'''Tiles are made for zoom values which are rounded to 1/1024 of a power of two.
+		For longitude this means the same tiles are used while the latitude does not change much.'''
+		return int (round (math.log (zoom, 2) * 1024))
 	def draw (self):
 		if not self.mapping:
 			return
+		if self.window is None:
+			self.draw_direct ()
+			return
+		cx, cy, zlat, zlon = self.map._factors ()
+		level = (self._level (self.map.zoom), self._level (zlon))
+		zoom = [2 ** (l / 1024.) for l in level]
+		renderer = self.map.renderer_name
+		t = self.tilesize
+		# Pixel coordinates on the whole map of the top left corner of the window.  Tile numbers increase to the east and south.
+		left = self.map.pos[1] * zoom[1] - cx
+		top = -self.map.pos[0] * zoom[0] - cy
+		xs = range (int (math.floor (left / t)), int (math.floor ((left + self.map.size[0]) / t)) + 1)
+		ys = range (int (math.floor (top / t)), int (math.floor ((top + self.map.size[1]) / t)) + 1)
+		missing = []
+		for y in ys:
+			for x in xs:
+				key = (renderer, level, x, y)
+				pixmap = self.tile (key)
+				if pixmap is None:
+					missing.append ((((x + .5) * t - left - cx) ** 2 + ((y + .5) * t - top - cy) ** 2, key))
+					continue
+				self.map.renderer.drawable (self.tilegc, pixmap, int (round (x * t - left)), int (round (y * t - top)), t, t)
+		# Only render tiles for the current view, the center first.
+		self.queue = [key for d, key in sorted (missing)]
+		self.visible = set (self.queue)
+		# After that, prepare the tiles next to the view in the direction the user is panning.
+		if self._last is not None and self._last[0] == level:
+			if left > self._last[1]:
+				self.queue += [(renderer, level, xs[-1] + 1, y) for y in ys]
+			elif left < self._last[1]:
+				self.queue += [(renderer, level, xs[0] - 1, y) for y in ys]
+			if top > self._last[2]:
+				self.queue += [(renderer, level, x, ys[-1] + 1) for x in xs]
+			elif top < self._last[2]:
+				self.queue += [(renderer, level, x, ys[0] - 1) for x in xs]
+		self._last = (level, left, top)
+		if len (self.queue) > 0 and self.render_handle is None:
+			self.render_handle = glib.idle_add (self.render_queue)
+	def draw_direct (self):
+		'''Draw the map without tiles.  This is used when there is no display, so there are no pixmaps.'''
 		ul = self.map.position ((0, 0))
-		ways, nodes = self.mapping.get (self.map.pos, (ul[0] - self.map.pos[0], self.map.pos[1] - ul[1]), self.map.size, self.map.zoom, 3000)
+		ways, nodes = self.mapping.get (self.map.pos, (ul[0] - self.map.pos[0], self.map.pos[1] - ul[1]), self.map.size, self.map.zoom, self.maxways)
+		# Keep the order of the ways, so roads are drawn over areas.
+		renderer = self.map.renderer_class (self.map.renderer.target, getattr (self.map.renderer, 'area', None), True)
 		for w in ways:
-			if len (w.rule) == 0:
-				continue
 			for rule in w.rule:
+				if rule[0]:
+					renderer.polygon (rule[1], True, w.nodes)
+				else:
+					renderer.lines (rule[1], w.nodes)
+		renderer.flush ()
+	def _path (self, key):
+		d = hashlib.md5 ('%s %s' % (self.cachekey, key[0])).hexdigest ()
+		return os.path.join (self.cachedir, d, '%d_%d' % key[1], '%d_%d.png' % key[2:])
+	def prune (self):
+		'''Remove the least recently used tiles from the cache directory until it is below 3/4 of its budget.'''
+		self._written = 0
+		files = []
+		total = 0
+		for root, dirs, names in os.walk (self.cachedir):
+			for n in names:
+				path = os.path.join (root, n)
+				try:
+					st = os.stat (path)
+				except OSError:
+					continue
+				files.append ((st.st_mtime, st.st_size, path))
+				total += st.st_size
+		if total <= self.disk:
+			return
+		files.sort ()
+		for mtime, size, path in files:
+			if total <= self.disk * 3 / 4:
+				break
+			try:
+				os.remove (path)
+			except OSError:
+				continue
+			total -= size
+	def tile (self, key):
+		'''Get a tile from memory or disk.  Return None if it has not been rendered yet.'''
+		pixmap = self.tiles.get (key)
+		if pixmap is not None:
+			return pixmap
+		path = self._path (key)
+		if not os.path.exists (path):
+			return None
+		try:
+			pixbuf = gtk.gdk.pixbuf_new_from_file (path)
+			# The modification time is used to find the tiles which were used least recently.
+			os.utime (path, None)
+		except (OSError, glib.GError):
+			traceback.print_exc ()
+			return None
+		pixmap = gtk.gdk.Pixmap (self.window, self.tilesize, self.tilesize)
+		pixmap.draw_pixbuf (None, pixbuf, 0, 0, 0, 0, self.tilesize, self.tilesize)
+		return self.tiles.put (key, pixmap, self.tilesize ** 2 * 4)
+	def render_queue (self):
+		'''Render queued tiles for a while and redraw the map.
+		GDK must only be used from the main thread, so this runs as an idle callback instead of in a thread.'''
+		start = time.time ()
+		done = False
+		while len (self.queue) > 0 and time.time () - start < .05:
+			key = self.queue.pop (0)
+			if key not in self.tiles.items and (key in self.visible or self.tile (key) is None):
+				self.tiles.put (key, self.render (key), self.tilesize ** 2 * 4)
+			done = done or key in self.visible
+		if done:
+			self.changed ()
+		if len (self.queue) == 0:
+			self.render_handle = None
+			return False
+		return True
+	def query (self, key):
+		'''Get the ways on a tile as a list of (rules, nodes), with nodes in pixels on the tile.
+		The map data is requested for the block of tiles around it, so the neighbouring tiles don't need a new query.'''
+		renderer, level, x, y = key
+		b = self.blocksize
+		block = (level, x // b, y // b)
+		ways = self.queries.get (block)
+		if ways is None:
+			zoom = [2 ** (l / 1024.) for l in level]
+			t = self.tilesize * b
+			center = (-(block[2] + .5) * t / zoom[0], (block[1] + .5) * t / zoom[1])
+			result, nodes = self.mapping.get (center, (t / 2. / zoom[0], t / 2. / zoom[1]), (t, t), zoom[0], self.maxways * b * b)
+			ways = []
+			for w in result:
+				if len (w.rule) == 0 or len (w.nodes) == 0:
+					continue
+				xs = [p[0] for p in w.nodes]
+				ys = [p[1] for p in w.nodes]
+				ways.append ((w.rule, w.nodes, (min (xs), min (ys), max (xs), max (ys))))
+			self.queries.put (block, ways, 64 + 16 * sum (len (w[1]) for w in ways))
+		# Move the nodes from the block to the tile; skip ways which are not on it.
+		t = self.tilesize
+		ox = (x - block[1] * b) * t
+		oy = (y - block[2] * b) * t
+		ret = []
+		for rules, nodes, box in ways:
+			if box[2] < ox or box[0] > ox + t or box[3] < oy or box[1] > oy + t:
+				continue
+			ret.append ((rules, [(p[0] - ox, p[1] - oy) for p in nodes]))
+		return ret
+	def stats (self):
+		'''Get statistics of the tile and query caches.'''
+		return {'tiles': self.tiles.stats (), 'queries': self.queries.stats ()}
+	def render (self, key):
+		'''Draw a tile from the map data and store it in the cache directory.'''
+		t = self.tilesize
+		pixmap = gtk.gdk.Pixmap (self.window, t, t)
+		pixmap.draw_rectangle (self.bggc, True, 0, 0, t, t)
+		renderer = renderers[key[0]] (pixmap, None, True)
+		for rules, nodes in self.query (key):
+			for rule in rules:
 				try:
 					if rule[0]:
-						self.map.buffer.draw_polygon (rule[1], True, w.nodes)
+						renderer.polygon (rule[1], True, nodes)
 					else:
-						self.map.buffer.draw_lines (rule[1], w.nodes)
+						renderer.lines (rule[1], nodes)
 				except:
 					traceback.print_exc ()
-				
+		renderer.flush ()
+		path = self._path (key)
+		try:
+			if not os.path.exists (os.path.dirname (path)):
+				os.makedirs (os.path.dirname (path))
+			pixbuf = gtk.gdk.Pixbuf (gtk.gdk.COLORSPACE_RGB, False, 8, t, t)
+			pixbuf.get_from_drawable (pixmap, gtk.gdk.colormap_get_system (), 0, 0, 0, 0, t, t)
+			pixbuf.save (path + '.part', 'png')
+			os.rename (path + '.part', path)
+			self._written += os.path.getsize (path)
+			if self._written > self.disk / 8:
+				self.prune ()
+		except (OSError, glib.GError):
+			# The tile is still used from memory.
+			traceback.print_exc ()
+		return pixmap
 
 class GridLayer (Layer):
 	'''A layer showing a grid'''
@@ -356,35 +932,186 @@ class GridLayer (Layer):
 		pass	#TODO
 
 class MarkerLayer (Layer):
-	'''A layer showing markers and tracks'''
+	'''A layer showing markers and tracks.
+	markers is a list of [pos, [selected, visible], ...]; tracks is a list of [points, [selected, visible], ...].
+	Positions must be changed with the methods below, so the bounding box and the index of the tracks stay valid.'''
+	cellsize = .01	# Size of a cell in the track index, in degrees.
+	maxcells = 64	# Tracks which cover more cells than this are not put in the index, but always checked.
+	tolerance = .5	# Maximum error of simplified tracks, in pixels.
 	def __init__ (self, map, color):
 		Layer.__init__ (self, map, color)
 		self.markers = []
 		self.tracks = []
+		self._box = None	# Bounding box of everything in the layer.
+		self._box_dirty = False	# If True, _box must be recomputed.
+		self._trackboxes = {}	# id (track) -> bounding box of its points.
+		self._grid = {}	# (lat cell, lon cell) -> {id (track): track}
+		self._large = {}	# id (track) -> track, for tracks which are not in _grid.
+		self._lod = {}	# id (track) -> {zoom level: simplified points}
 	def draw (self):
 		if not hasattr (self, 'gc'):
 			return
+		# Markers outside the view are drawn as arrows on its border, which move when panning; they are in the overlay.
 		for m in self.markers:
+			if self.static and not self.on_screen (m[0]):
+				continue
 			self.draw_marker (m[0], m[1])
-		for t in self.tracks:
-			if t is None:
+		view = self.map.viewbox ()
+		# Clip a bit outside the window, so line ends are not drawn at the border.
+		margin = 4
+		clipbox = (-margin, -margin, self.map.size[0] + margin, self.map.size[1] + margin)
+		for t in self.find_tracks (view):
+			if len (t[0]) < 2:
 				continue
-			pixt = [self.map.pixel (x) for x in t[0]]
-			for p in range (len (pixt) - 1):
-				try:
-					self.map.buffer.draw_line (self.gc[2 * t[1][0] + (not t[1][1])], pixt[p][0], pixt[p][1], pixt[p + 1][0], pixt[p + 1][1])
-				except:
-					# If the numbers are too far out of bounds, there is an exception.  The line would not have been on screen anyway.
-					pass
-	def boundingbox (self, box):
-		for m in self.markers:
-			box = self.boundingbox_add (box, m[0])
-		for t in self.tracks:
-			if t is None:
+			box = self._trackboxes[id (t)]
+			gc = self.gc[2 * t[1][0] + (not t[1][1])]
+			points = self.detail (t)
+			if view[0] <= box[0] and box[2] <= view[2] and view[1] <= box[1] and box[3] <= view[3]:
+				# Completely on screen.
+				self.map.renderer.lines (gc, self.map.pixels (points))
 				continue
-			for p in t[0]:
-				box = self.boundingbox_add (box, p)
-		return box
+			for part in clip_lines (self.map.pixels (points, False), clipbox):
+				self.map.renderer.lines (gc, part)
+	def draw_overlay (self):
+		if not hasattr (self, 'gc') or not self.static:
+			return
+		for m in self.markers:
+			if not self.on_screen (m[0]):
+				self.draw_marker (m[0], m[1])
+	# Changing markers and tracks. {{{
+	def set_markers (self, markers):
+		'''Replace all markers.'''
+		self.dirty = True
+		self.markers = markers
+		self._box_dirty = True
+	def add_marker (self, marker):
+		'''Add a marker [pos, [selected, visible], ...]; return its index.'''
+		self.dirty = True
+		self.markers.append (marker)
+		self._extend (marker[0])
+		return len (self.markers) - 1
+	def remove_marker (self, idx):
+		self.dirty = True
+		marker = self.markers.pop (idx)
+		self._shrink (marker[0])
+		return marker
+	def move_marker (self, idx, pos):
+		marker = self.markers[idx]
+		if marker[0] == pos:
+			return
+		self._shrink (marker[0])
+		marker[0] = pos
+		self._extend (pos)
+		self.dirty = True
+	def add_track (self, track):
+		'''Add a track [points, [selected, visible], ...]; return its index.'''
+		self.dirty = True
+		self.tracks.append (track)
+		self._index (track)
+		return len (self.tracks) - 1
+	def remove_track (self, idx):
+		self.dirty = True
+		track = self.tracks.pop (idx)
+		self._unindex (track)
+		return track
+	def set_track (self, idx, points):
+		'''Replace the points of a track.'''
+		track = self.tracks[idx]
+		if track[0] == points:
+			return
+		self._unindex (track)
+		track[0] = points
+		self._index (track)
+		self.dirty = True
+	# }}}
+	# Bounding box and index. {{{
+	def _extend (self, point):
+		if not self._box_dirty:
+			self._box = self.boundingbox_add (self._box, point)
+	def _shrink (self, point):
+		'''Update the bounding box for a removed point.  It is only recomputed if the point was on its edge.'''
+		box = self._box
+		if box is not None and (point[0] in (box[0], box[2]) or point[1] in (box[1], box[3])):
+			self._box_dirty = True
+	def _cells (self, box):
+		c = self.cellsize
+		return [(i, j) for i in range (int (math.floor (box[0] / c)), int (math.floor (box[2] / c)) + 1) for j in range (int (math.floor (box[1] / c)), int (math.floor (box[3] / c)) + 1)]
+	def _num_cells (self, box):
+		c = self.cellsize
+		return (int (math.floor (box[2] / c)) - int (math.floor (box[0] / c)) + 1) * (int (math.floor (box[3] / c)) - int (math.floor (box[1] / c)) + 1)
+	def _index (self, track):
+		box = None
+		for p in track[0]:
+			box = self.boundingbox_add (box, p)
+		if box is None:
+			return
+		self._trackboxes[id (track)] = box
+		self._extend (box[:2])
+		self._extend (box[2:])
+		if self._num_cells (box) > self.maxcells:
+			self._large[id (track)] = track
+			return
+		for cell in self._cells (box):
+			self._grid.setdefault (cell, {})[id (track)] = track
+	def _unindex (self, track):
+		self._lod.pop (id (track), None)
+		box = self._trackboxes.pop (id (track), None)
+		if box is None:
+			return
+		self._shrink (box[:2])
+		self._shrink (box[2:])
+		if self._large.pop (id (track), None) is not None:
+			return
+		for cell in self._cells (box):
+			tracks = self._grid[cell]
+			del tracks[id (track)]
+			if len (tracks) == 0:
+				del self._grid[cell]
+	def detail (self, track):
+		'''Get the points of a track, simplified for the current zoom.
+		They are computed once for every power of two of the zoom, and kept until the track changes.'''
+		if len (track[0]) <= 3:
+			return track[0]
+		level = int (math.floor (math.log (self.map.zoom, 2)))
+		lod = self._lod.setdefault (id (track), {})
+		if level not in lod:
+			box = self._trackboxes[id (track)]
+			scale = math.cos (math.radians ((box[0] + box[2]) / 2.))
+			lod[level] = simplify (track[0], self.tolerance / 2. ** level, scale)
+		return lod[level]
+	def find_tracks (self, box):
+		'''Get all tracks which have points and whose bounding box overlaps box (minlat, minlon, maxlat, maxlon).'''
+		if self._num_cells (box) > len (self.tracks):
+			# Checking all tracks is cheaper than visiting all cells.
+			candidates = [t for t in self.tracks if id (t) in self._trackboxes]
+		else:
+			found = dict (self._large)
+			for cell in self._cells (box):
+				found.update (self._grid.get (cell, {}))
+			candidates = found.values ()
+		ret = []
+		for t in candidates:
+			b = self._trackboxes[id (t)]
+			if b[0] <= box[2] and box[0] <= b[2] and b[1] <= box[3] and box[1] <= b[3]:
+				ret.append (t)
+		return ret
+	def bbox (self):
+		'''Get the bounding box of all markers and tracks, or None if the layer is empty.'''
+		if self._box_dirty:
+			self._box = None
+			self._box_dirty = False
+			for m in self.markers:
+				self._box = self.boundingbox_add (self._box, m[0])
+			for b in self._trackboxes.values ():
+				self._box = self.boundingbox_add (self._box, b[:2])
+				self._box = self.boundingbox_add (self._box, b[2:])
+		return self._box
+	def boundingbox (self, box):
+		b = self.bbox ()
+		if b is None:
+			return box
+		box = self.boundingbox_add (box, b[:2])
+		return self.boundingbox_add (box, b[2:])
 	def boundingbox_add (self, box, point):
 		if box is None:
 			return [point[0], point[1], point[0], point[1]]
@@ -397,11 +1124,13 @@ class MarkerLayer (Layer):
 		if box[3] < point[1]:
 			box[3] = point[1]
 		return box
+	# }}}
 
 class PositionLayer (MarkerLayer):
 	'''A layer showing the current position'''
+	static = False
 	def __init__ (self, map, color):
 		MarkerLayer.__init__ (self, map, color)
-		self.markers = [[(self.map.pos[0], self.map.pos[1], None, None), [True, True]]]
+		self.set_markers ([[(self.map.pos[0], self.map.pos[1], None, None), [True, True]]])
 		assert self.map.positionlayer == None
 		self.map.positionlayer = self
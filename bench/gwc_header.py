@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+# gwc_header.py - Compare gwc header parsing speed for xmarksthespot
+# Copyright 2012 Bas Wijnen <wijnen@debian.org>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''Parse the header of a synthetic cartridge with the struct based parser in gwc.py
+and with the per-field parser it replaced, and print the time both take.'''
+
+import os
+import sys
+import struct
+import timeit
+import StringIO
+sys.path.insert (0, os.path.join (os.path.dirname (os.path.abspath (__file__)), os.pardir))
+import gwc
+
+# The old parser. {{{
+def _short (file, pos):
+	ret = struct.unpack ('<h', file[pos[0]:pos[0] + 2])[0]
+	pos[0] += 2
+	return ret
+
+def _int (file, pos):
+	ret = struct.unpack ('<i', file[pos[0]:pos[0] + 4])[0]
+	pos[0] += 4
+	return ret
+
+def _double (file, pos):
+	ret = struct.unpack ('<d', file[pos[0]:pos[0] + 8])[0]
+	pos[0] += 8
+	return ret
+
+def _string (file, pos):
+	p = file.find ('\0', pos[0])
+	assert p >= 0
+	ret = file[pos[0]:p]
+	pos[0] = p + 1
+	return ret
+
+def old_header (file, target):
+	pos = [len (gwc._CARTID)]
+	num = _short (file, pos)
+	offset = [None] * num
+	rid = [None] * num
+	for i in range (num):
+		rid[i] = _short (file, pos)
+		offset[i] = _int (file, pos)
+	size = _int (file, pos)
+	target.latitude = _double (file, pos)
+	target.longitude = _double (file, pos)
+	target.altitude = _double (file, pos)
+	pos[0] += 4 + 4
+	target.splashId = _short (file, pos)
+	target.iconId = _short (file, pos)
+	for name in ('gametype', 'user'):
+		setattr (target, name, _string (file, pos))
+	pos[0] += 4 + 4
+	for name in ('name', 'guid', 'description', 'startdesc', 'version', 'author', 'url', 'device'):
+		setattr (target, name, _string (file, pos))
+	pos[0] += 4
+	target.completion_code = _string (file, pos)
+	return zip (rid, offset)
+# }}}
+
+class Info:
+	pass
+
+def make_cartridge (num):
+	info = Info ()
+	for key in ('gametype', 'user', 'name', 'guid', 'description', 'startdesc', 'version', 'author', 'url', 'device', 'completion_code'):
+		setattr (info, key, key)
+	info.latitude, info.longitude, info.altitude = 52., 4., 0.
+	target = StringIO.StringIO ()
+	gwc.write_cartridge (target, info, 'lua', ['x'] * (num - 1))
+	return target.getvalue ()
+
+if __name__ == '__main__':
+	num = int (sys.argv[1]) if len (sys.argv) > 1 else 10000
+	file = make_cartridge (num)
+	assert old_header (file, Info ()) == gwc._read_gwc_header (file, Info ())
+	for name, parser in (('per field', old_header), ('struct', gwc._read_gwc_header)):
+		t = min (timeit.repeat (lambda: parser (file, Info ()), number = 10, repeat = 5)) / 10
+		print ('%-10s %d resources: %.3f ms' % (name, num, t * 1000))
@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+# list_update.py - Compare list refresh speed of the xmarksthespot widgets
+# Copyright 2012 Bas Wijnen <wijnen@debian.org>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''Refresh a gtk.ListStore with 10, 1000 and 10000 objects, with the keyed rows in widgets.List
+and (for the smaller ones) with the list scanning implementation it replaced.
+Both a refresh without changes and one where 1% of the objects changed are timed,
+and the number of icons which were made is counted.'''
+
+import os
+import sys
+import time
+import gtk
+sys.path.insert (0, os.path.join (os.path.dirname (os.path.abspath (__file__)), os.pardir))
+import widgets
+
+class Obj:
+	def __init__ (self, n):
+		self.Name = 'object %d' % n
+		self.Active = True
+		self.Visible = True
+		self.Icon = None
+
+class Reconciler (object):
+	'''The row handling of widgets.List, without the rest of the widget.'''
+	rebuild = widgets.List.__dict__['rebuild']
+	_write = widgets.List.__dict__['_write']
+	_remove = widgets.List.__dict__['_remove']
+	icon_key = widgets.List.__dict__['icon_key']
+	color = '#000'
+	def __init__ (self, objects):
+		self.store = gtk.ListStore (str, str, object, bool, bool, gtk.gdk.Pixbuf)
+		self.rows = {}
+		self.objects = objects
+		self.icons = 0
+		class Data:
+			class gameobject:
+				class AllZObjects:
+					@staticmethod
+					def list ():
+						return self.objects
+		self.data = Data
+	def must_show (self, item):
+		return item.Active
+	def make_icon (self, item):
+		self.icons += 1
+		return None
+	def add_item (self, item):
+		pass
+	def remove_item (self, item):
+		pass
+	def _updated (self):
+		self.size = len (self.rows)
+
+# The old implementation. {{{
+class Old (Reconciler):
+	def rebuild (self):
+		keys, full = [], []
+		for i in self.data.gameobject.AllZObjects.list ():
+			if self.must_show (i):
+				keys.append (i)
+				full.append ((i.Name, self.color, i, i.Active, i.Visible, None))
+		self.size = 0
+		current = self.store.get_iter_first ()
+		while current:
+			next = self.store.iter_next (current)
+			k = self.store.get_value (current, 2)
+			if k in keys:
+				i = keys.index (k)
+				self.size += 1
+				keys.pop (i)
+				full.pop (i)
+			else:
+				self.store.remove (current)
+				self.remove_item (k)
+			current = next
+		for f in full:
+			self.size += 1
+			self.store.append (f)
+			self.add_item (f[2])
+		current = self.store.get_iter_first ()
+		while current:
+			i = self.store.get_value (current, 2)
+			self.store.set_value (current, 3, i.Active != 0)
+			self.store.set_value (current, 4, i.Visible != 0)
+			self.store.set_value (current, 5, self.make_icon (i))
+			current = self.store.iter_next (current)
+# }}}
+
+def run (cls, num):
+	objects = [Obj (n) for n in range (num)]
+	r = cls (objects)
+	r.rebuild ()
+	r.icons = 0
+	start = time.time ()
+	r.rebuild ()
+	same = time.time () - start
+	for o in objects[::100]:
+		o.Visible = False
+		o.Name += '!'
+	start = time.time ()
+	r.rebuild ()
+	changed = time.time () - start
+	assert r.size == num
+	return same, changed, r.icons
+
+if __name__ == '__main__':
+	for num in (10, 1000, 10000):
+		for name, cls in (('keyed', Reconciler), ('old', Old)):
+			if cls is Old and num > 1000:
+				continue
+			same, changed, icons = run (cls, num)
+			print ('%-6s %5d objects: unchanged %8.3f ms, 1%% changed %8.3f ms, %5d icons made' % (name, num, same * 1000, changed * 1000, icons))
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+# mangle.py - Compare string mangling speed of gwz2wfz
+# Copyright 2012-2015 Bas Wijnen <wijnen@debian.org>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''Mangle generated lua sources of increasing size with the single pass tokenizer in gwz2wfz,
+and (for the smaller ones) with the search and slice implementation it replaced.
+The time per MB should stay constant for the tokenizer.'''
+
+import os
+import re
+import sys
+import time
+import importlib.util
+import importlib.machinery
+
+path = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'converter', 'gwz2wfz')
+loader = importlib.machinery.SourceFileLoader('gwz2wfz', path)
+gwz2wfz = importlib.util.module_from_spec(importlib.util.spec_from_loader('gwz2wfz', loader))
+loader.exec_module(gwz2wfz)
+
+def old_mangle_string(self, orig): # {{{
+	ret = b''
+	start_re = re.compile(rb'''--|"|'|\[(=*)\[''')
+	comment_re = re.compile(rb'''\[(=*)\[''')
+	end_re1 = re.compile(rb"""(?:[^\']|\.)*'""")
+	end_re2 = re.compile(rb'''(?:[^\"]|\.)*"''')
+	escape_re = re.compile(rb'''\\.''')
+	def find_end(end_re, orig):
+		pos = 0
+		while True:
+			end = end_re.search(orig, pos)
+			escape = escape_re.search(orig, pos)
+			if escape and escape.start() < end.end():
+				pos = escape.end()
+				continue
+			return end.end() - 1
+	while True:
+		pos = start_re.search(orig)
+		if pos is None:
+			return ret + orig
+		ret += orig[:pos.end()]
+		orig = orig[pos.end():]
+		if pos.group(0) == b'--':
+			if comment_re.match(orig[2:]):
+				ret += orig[:2]
+				orig = orig[2:]
+				pos = start_re.match(orig)
+			else:
+				end = orig.find(b'\n')
+				ret += orig[:end + 1]
+				orig = orig[end + 1:]
+				continue
+		if pos.group(0) == b"'":
+			end = find_end(end_re1, orig)
+		elif pos.group(0) == b'"':
+			end = find_end(end_re2, orig)
+		else:
+			end = orig.find(b']' + pos.group(1) + b']')
+		ret += self.mangle(orig[:end + 1])
+		orig = orig[end + 1:]
+# }}}
+
+def generate(size):
+	'''Generate about size bytes of lua code with many strings and comments.'''
+	chunk = b'''\
+-- Zone %d.
+zone%d = Wherigo.Zone(cart)
+zone%d.Name = "Zone <%d> & \\"friends\\""
+zone%d.Description = 'It\\'s  a\tzone\\n'
+zone%d.Media = [[long
+string %d]] --[==[ one line comment ]==]
+'''
+	parts = []
+	total = 0
+	i = 0
+	while total < size:
+		part = chunk.replace(b'%d', b'%d' % i)
+		parts.append(part)
+		total += len(part)
+		i += 1
+	return b''.join(parts)
+
+if __name__ == '__main__':
+	c = gwz2wfz.Converter.__new__(gwz2wfz.Converter)
+	for mb in (.25, .5, 1, 2, 4, 8):
+		source = generate(int(mb * (1 << 20)))
+		start = time.time()
+		new = c.mangle_string(source)
+		t = time.time() - start
+		line = '%5.2f MB: tokenizer %.3f s (%.3f s/MB)' % (mb, t, t / mb)
+		if mb <= 1:
+			start = time.time()
+			assert old_mangle_string(c, source) == new
+			t = time.time() - start
+			line += ', old %.3f s (%.3f s/MB)' % (t, t / mb)
+		print(line)
@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+# catalog.py - Index of cartridge libraries for xmarksthespot
+# Copyright 2012 Bas Wijnen <wijnen@debian.org>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''Keep an sqlite index of the metadata of all cartridges in a directory tree.
+Metadata is read with gwc.open_index, so no lua code is run.  Only files which
+have changed since the previous scan (by path, modification time and size) are read again.'''
+
+import os
+import sys
+import math
+import sqlite3
+import argparse
+import traceback
+import multiprocessing
+import glib
+import gwc
+
+_EXTENSIONS = (os.extsep + 'gwc', os.extsep + 'gwz')
+_FIELDS = ('name', 'guid', 'author', 'version', 'description', 'latitude', 'longitude', 'altitude')
+_EARTH_RADIUS = 6371.	# km
+
+def default_db ():
+	return os.path.join (glib.get_user_data_dir (), 'xmarksthespot', 'catalog.sqlite')
+
+def open_db (filename = None):
+	'''Open (and if needed create) the catalog database.'''
+	if filename is None:
+		filename = default_db ()
+	d = os.path.dirname (filename)
+	if d and not os.path.exists (d):
+		os.makedirs (d)
+	db = sqlite3.connect (filename)
+	db.text_factory = str
+	db.execute ('CREATE TABLE IF NOT EXISTS cartridges (path TEXT PRIMARY KEY, mtime REAL, size INTEGER, %s, error TEXT)' % ', '.join (_FIELDS))
+	db.execute ('CREATE INDEX IF NOT EXISTS cartridges_location ON cartridges (latitude, longitude)')
+	return db
+
+def _read (job):
+	'''Read metadata of one file.  This runs in a worker process.'''
+	path, mtime, size = job
+	try:
+		info = gwc.open_index (path)
+		return (path, mtime, size) + tuple (getattr (info, key) for key in _FIELDS) + (None,)
+	except:
+		return (path, mtime, size) + (None,) * len (_FIELDS) + (traceback.format_exc ().strip ().split ('\n')[-1],)
+
+def _walk (dirs):
+	for d in dirs:
+		for root, subdirs, files in os.walk (d):
+			for f in files:
+				if os.path.splitext (f)[1].lower () in _EXTENSIONS:
+					yield os.path.abspath (os.path.join (root, f))
+
+def scan (db, dirs, processes = None):
+	'''Update the catalog with all cartridges below dirs.  Return (number of files read, number of files removed).'''
+	known = dict ((row[0], row[1:]) for row in db.execute ('SELECT path, mtime, size FROM cartridges'))
+	jobs = []
+	seen = set ()
+	for path in _walk (dirs):
+		seen.add (path)
+		st = os.stat (path)
+		if known.get (path) == (st.st_mtime, st.st_size):
+			continue
+		jobs.append ((path, st.st_mtime, st.st_size))
+	if len (jobs) > 0:
+		pool = multiprocessing.Pool (processes)
+		try:
+			for row in pool.imap_unordered (_read, jobs, 16):
+				db.execute ('INSERT OR REPLACE INTO cartridges VALUES (%s)' % ', '.join ('?' * len (row)), row)
+		finally:
+			pool.close ()
+			pool.join ()
+	# Forget files which were removed from the scanned directories.
+	roots = [os.path.join (os.path.abspath (d), '') for d in dirs]
+	gone = [path for path in known if path not in seen and any (path.startswith (r) for r in roots)]
+	for path in gone:
+		db.execute ('DELETE FROM cartridges WHERE path = ?', (path,))
+	db.commit ()
+	return len (jobs), len (gone)
+
+def distance (lat1, lon1, lat2, lon2):
+	'''Great circle distance in km.'''
+	lat1, lon1, lat2, lon2 = [math.radians (x) for x in (lat1, lon1, lat2, lon2)]
+	a = math.sin ((lat2 - lat1) / 2) ** 2 + math.cos (lat1) * math.cos (lat2) * math.sin ((lon2 - lon1) / 2) ** 2
+	return 2 * _EARTH_RADIUS * math.asin (min (1, math.sqrt (a)))
+
+def search (db, name = None, author = None, near = None, limit = None):
+	'''Find cartridges.  name and author match substrings, case insensitive.
+	near is (latitude, longitude, radius in km).  Return a list of dicts, nearest first if near is given.'''
+	where = ['error IS NULL']
+	args = []
+	if name:
+		where.append ('name LIKE ?')
+		args.append ('%' + name + '%')
+	if author:
+		where.append ('author LIKE ?')
+		args.append ('%' + author + '%')
+	if near is not None:
+		# Use the index to select a bounding box; the exact distance is checked below.
+		lat, lon, radius = near
+		dlat = math.degrees (radius / _EARTH_RADIUS)
+		where.append ('latitude BETWEEN ? AND ?')
+		args += [lat - dlat, lat + dlat]
+		coslat = math.cos (math.radians (min (89.9, abs (lat) + dlat)))
+		dlon = dlat / coslat
+		if dlon < 180:
+			lo, hi = lon - dlon, lon + dlon
+			if lo < -180:
+				# The box crosses the antimeridian; select both sides of it.
+				where.append ('(longitude BETWEEN ? AND 180 OR longitude BETWEEN -180 AND ?)')
+				args += [lo + 360, hi]
+			elif hi > 180:
+				where.append ('(longitude BETWEEN ? AND 180 OR longitude BETWEEN -180 AND ?)')
+				args += [lo, hi - 360]
+			else:
+				where.append ('longitude BETWEEN ? AND ?')
+				args += [lo, hi]
+	query = 'SELECT path, %s FROM cartridges WHERE %s ORDER BY name' % (', '.join (_FIELDS), ' AND '.join (where))
+	ret = []
+	for row in db.execute (query, args):
+		item = dict (zip (('path',) + _FIELDS, row))
+		if near is not None:
+			if item['latitude'] is None or item['longitude'] is None:
+				continue
+			item['distance'] = distance (lat, lon, item['latitude'], item['longitude'])
+			if item['distance'] > radius:
+				continue
+		ret.append (item)
+	if near is not None:
+		ret.sort (key = lambda x: x['distance'])
+	return ret[:limit] if limit is not None else ret
+
+def main ():
+	a = argparse.ArgumentParser (description = 'Keep an index of wherigo cartridges')
+	a.add_argument ('--db', help = 'catalog database (default: %s)' % default_db (), default = None)
+	sub = a.add_subparsers (dest = 'command')
+	s = sub.add_parser ('scan', help = 'add or update all cartridges in directories')
+	s.add_argument ('dirs', nargs = '+', help = 'directories to scan')
+	s.add_argument ('--processes', type = int, default = None, help = 'number of worker processes (default: number of cpus)')
+	s = sub.add_parser ('search', help = 'find cartridges in the catalog')
+	s.add_argument ('--name', default = None, help = 'part of the cartridge name')
+	s.add_argument ('--author', default = None, help = 'part of the author name')
+	s.add_argument ('--near', type = float, nargs = 3, default = None, metavar = ('LAT', 'LON', 'KM'), help = 'starting location within radius')
+	s.add_argument ('--limit', type = int, default = None, help = 'maximum number of results')
+	args = a.parse_args ()
+	db = open_db (args.db)
+	if args.command == 'scan':
+		read, removed = scan (db, args.dirs, args.processes)
+		sys.stderr.write ('%d files read, %d removed\n' % (read, removed))
+	else:
+		for item in search (db, args.name, args.author, args.near, args.limit):
+			dist = ' (%.1f km)' % item['distance'] if 'distance' in item else ''
+			print ('%s\t%s\t%s%s' % (item['path'], item['name'], item['author'], dist))
+
+if __name__ == '__main__':
+	main ()
@@ -18,34 +18,176 @@
 import struct
 import zipfile
 import os
+import mmap
+import collections
+import shutil
+import re
+import functools
 import lua
 import sys
 import wherigo
 
 _CARTID = '\x02\x0aCART\x00'
 
-def _short (file, pos):
-	ret = struct.unpack ('<h', file[pos[0]:pos[0] + 2])[0]
-	pos[0] += 2
-	return ret
+# Precompiled parsers for the fixed size parts of a gwc file.
+_SHORT = struct.Struct ('<h')
+_INT = struct.Struct ('<i')
+_LOCATION = struct.Struct ('<ddd8xhh')	# latitude, longitude, altitude, (unused), splashId, iconId
+_MEDIA = struct.Struct ('<ii')	# filetype, size
 
-def _int (file, pos):
-	ret = struct.unpack ('<i', file[pos[0]:pos[0] + 4])[0]
-	pos[0] += 4
-	return ret
+def _strings (file, pos, target, names):
+	'''Read consecutive 0-terminated strings into attributes of target.  Return the position after them.'''
+	for name in names:
+		p = file.find ('\0', pos)
+		assert p >= 0
+		setattr (target, name, file[pos:p])
+		pos = p + 1
+	return pos
 
-def _double (file, pos):
-	ret = struct.unpack ('<d', file[pos[0]:pos[0] + 8])[0]
-	pos[0] += 8
-	return ret
+def _read_gwc_header (file, target):
+	'''Parse the header of a gwc file into attributes of target.
+	Return the resource table as a list of (id, offset) tuples.'''
+	pos = len (_CARTID)
+	num = _SHORT.unpack_from (file, pos)[0]
+	pos += _SHORT.size
+	# Parse the entire table with one call.
+	table = struct.unpack_from ('<' + 'hi' * num, file, pos)
+	assert num == 0 or max (table[0::2]) < num
+	pos += 6 * num
+	size = _INT.unpack_from (file, pos)[0]
+	pos += _INT.size
+	end = pos + size
+	target.latitude, target.longitude, target.altitude, target.splashId, target.iconId = _LOCATION.unpack_from (file, pos)
+	pos += _LOCATION.size
+	pos = _strings (file, pos, target, ('gametype', 'user'))
+	pos += 4 + 4
+	pos = _strings (file, pos, target, ('name', 'guid', 'description', 'startdesc', 'version', 'author', 'url', 'device'))
+	pos += 4
+	pos = _strings (file, pos, target, ('completion_code',))
+	assert pos == end
+	return zip (table[0::2], table[1::2])
 
-def _string (file, pos):
-	ret = ''
-	p = file.find ('\0', pos[0])
-	assert p >= 0
-	ret = file[pos[0]:p]
-	pos[0] = p + 1
-	return ret
+def _gwc_resources (file, table):
+	'''Walk the resource table of a gwc file.
+	Yield (id, filetype, offset, size) for every resource that is present; filetype is None for the lua code.'''
+	offset = table[0][1]
+	yield 0, None, offset + _INT.size, _INT.unpack_from (file, offset)[0]
+	for rid, offset in table[1:]:
+		if file[offset] == '\0':
+			continue
+		filetype, size = _MEDIA.unpack_from (file, offset + 1)
+		yield rid, filetype, offset + 1 + _MEDIA.size, size
+
+def _map (filename):
+	'''Map a file into memory, so its contents are only read from disk when they are used.'''
+	f = open (filename, 'rb')
+	try:
+		return mmap.mmap (f.fileno (), 0, access = mmap.ACCESS_READ)
+	except (EnvironmentError, ValueError):
+		# Empty files and some file systems cannot be mapped; read them instead.
+		return f.read ()
+	finally:
+		f.close ()
+
+def _read_file (filename):
+	with open (filename, 'rb') as f:
+		return f.read ()
+
+class ResourceCache:
+	'''Cache for resources and decoded media, shared by the cartridge loaders and the user interface.
+	It holds at most budget bytes; the least recently used items are evicted when it is full.'''
+	def __init__ (self, budget = 32 << 20):
+		self.budget = budget
+		self.size = 0
+		self.items = collections.OrderedDict ()
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+	def get (self, key, default = None):
+		try:
+			item = self.items.pop (key)
+		except KeyError:
+			self.misses += 1
+			return default
+		# Reinsert item to mark it as most recently used.
+		self.items[key] = item
+		self.hits += 1
+		return item[0]
+	def put (self, key, value, size = None):
+		'''Store value in the cache and return it.  If size is None, len (value) is used.'''
+		if size is None:
+			size = len (value)
+		self.discard (key)
+		if size > self.budget:
+			# Don't flush everything for an item which doesn't fit anyway.
+			return value
+		self.items[key] = (value, size)
+		self.size += size
+		self._evict ()
+		return value
+	def discard (self, key):
+		item = self.items.pop (key, None)
+		if item is not None:
+			self.size -= item[1]
+	def clear (self):
+		self.items.clear ()
+		self.size = 0
+	def set_budget (self, budget):
+		self.budget = budget
+		self._evict ()
+	def _evict (self):
+		while self.size > self.budget:
+			key, item = self.items.popitem (last = False)
+			self.size -= item[1]
+			self.evictions += 1
+	def stats (self):
+		return {'items': len (self.items), 'size': self.size, 'budget': self.budget, 'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+# The cache which is used for all cartridges.
+cache = ResourceCache ()
+
+class _Resources:
+	'''List of cartridge resources.
+	Items are either strings, (offset, size) references into buffer, or functions which return the data.
+	References and functions are only used when the item is requested,
+	and the results are kept in the shared cache.'''
+	def __init__ (self, buffer, num):
+		self.buffer = buffer
+		self.items = [None] * num
+	def set_ref (self, idx, offset, size):
+		self.items[idx] = (offset, size)
+	def view (self, idx):
+		'''Get a resource without copying it.'''
+		item = self.items[idx]
+		if isinstance (item, tuple):
+			return buffer (self.buffer, item[0], item[1])
+		if callable (item):
+			return self[idx]
+		return item
+	def __len__ (self):
+		return len (self.items)
+	def __getitem__ (self, idx):
+		if isinstance (idx, slice):
+			return [self[i] for i in range (*idx.indices (len (self.items)))]
+		item = self.items[idx]
+		if not isinstance (item, tuple) and not callable (item):
+			return item
+		key = (self, idx % len (self.items))
+		ret = cache.get (key)
+		if ret is None:
+			ret = cache.put (key, item () if callable (item) else self.buffer[item[0]:item[0] + item[1]])
+		return ret
+	def __setitem__ (self, idx, value):
+		cache.discard ((self, idx % len (self.items)))
+		self.items[idx] = value
+	def __iter__ (self):
+		for idx in range (len (self.items)):
+			yield self[idx]
+	def append (self, value):
+		self.items.append (value)
+	def __iadd__ (self, values):
+		self.items += list (values)
+		return self
 
 def _wshort (num):
 	return struct.pack ('<h', num)
@@ -61,25 +203,32 @@ def _wstring (s):
 	return s + '\0'
 
 class cartridge:
-	def __init__ (self, file, script, cbs, config):
+	def __init__ (self, file, script, cbs, config, use_mmap = True):
+		'''Load a cartridge.  File is a file object, the contents of a gwc file, or a path to a gwc or gwz file or gwz directory.
+		If use_mmap is True, gwc files are mapped into memory and resources are only read when they are used.'''
+		filename = None
 		if type (file) is not str:
 			file = file.read ()
 		if not file.startswith (_CARTID):
+			filename = file
 			if os.path.isdir (file):
 				# This is a gwz directory.
 				gwc = False
 				data = self._read_gwz (file, True, config)
 			else:
-				file = open (file).read ()
-				if file.startswith (_CARTID):
+				file = _map (filename) if use_mmap else open (filename, 'rb').read ()
+				if file[:len (_CARTID)] == _CARTID:
 					# This is a gwc file.
 					gwc  = True
 					self._read_gwc (file)
 				else:
-					# This should be a gwz file.
+					# This should be a gwz file.  The zip file is opened separately, so the map is not needed.
+					if isinstance (file, mmap.mmap):
+						file.close ()
 					gwc = False
-					data = self._read_gwz (file, False, config)
+					data = self._read_gwz (filename, False, config)
 		else:
+			gwc = True
 			self._read_gwc (file)
 		env = {}
 		for i in config:
@@ -87,7 +236,7 @@ class cartridge:
 				env[i[4:]] = config[i]
 		env['Downloaded'] = int (env['Downloaded'])
 		if not env['CartFilename']:
-			env['CartFilename'] = os.path.splitext (file)[0]
+			env['CartFilename'] = os.path.splitext (filename)[0] if filename is not None else ''
 		if not env['Device']:
 			env['Device'] = self.device
 		wherigo._script.run ('', 'Env', env, name = 'setting Env')
@@ -97,52 +246,16 @@ class cartridge:
 			cartridge = wherigo.ZCartridge ()
 			cartridge._setup (self, cbs)
 	def _read_gwc (self, file):
-		pos = [len (_CARTID)]	# make this an array so it can be changed by functions.
-		num = _short (file, pos)
-		offset = [None] * num
-		rid = [None] * num
+		table = _read_gwc_header (file, self)
+		num = len (table)
 		#self.filetype = [None] * num
-		self.data = [None] * num
-		for i in range (num):
-			rid[i] = _short (file, pos)
-			assert rid[i] < num
-			offset[i] = _int (file, pos)
-		size = _int (file, pos)
-		self.latitude = _double (file, pos)
-		self.longitude = _double (file, pos)
-		self.altitude = _double (file, pos)
-		pos[0] += 4 + 4
-		self.splashId = _short (file, pos)
-		self.iconId = _short (file, pos)
-		self.gametype = _string (file, pos)
-		self.user = _string (file, pos)
-		pos[0] += 4 + 4
-		self.name = _string (file, pos)
-		self.guid = _string (file, pos)
-		self.description = _string (file, pos)
-		self.startdesc = _string (file, pos)
-		self.version = _string (file, pos)
-		self.author = _string (file, pos)
-		self.url = _string (file, pos)
-		self.device = _string (file, pos)
-		pos[0] += 4
-		self.completion_code = _string (file, pos)
-		assert pos[0] == len (_CARTID) + 2 + num * 6 + 4 + size
-		# read lua bytecode.
-		pos[0] = offset[0]
-		size = _int (file, pos)
-		self.data[0] = file[pos[0]:pos[0] + size]
-		# read all other files.
-		for i in range (1, num):
-			pos[0] = offset[i]
-			if file[pos[0]] == '\0':
-				continue
-			pos[0] += 1
-			filetype = _int (file, pos)	# Not used.
-			size = _int (file, pos)
-			self.data[rid[i]] = file[pos[0]:pos[0] + size]
+		self.data = _Resources (file, num)
+		# Record where the lua bytecode and all other files are; they are read when they are used.
+		for rid, filetype, offset, size in _gwc_resources (file, table):	# filetype is not used.
+			self.data.set_ref (rid, offset, size)
 	def _read_gwz (self, gwz, isdir, config):
 		# Read gwz file or directory. gwz is path to data. Media files are given their id from the lua source.
+		# Only the lua code is read here; for media files a function to read them is stored.
 		data = {}
 		code = None	# This is the name of the lua code file.
 		if isdir:
@@ -154,15 +267,16 @@ class cartridge:
 			ln = n.lower ()
 			assert ln not in data
 			if isdir:
-				data[ln] = open (os.path.join (gwz, n), 'rb').read ()
+				data[ln] = functools.partial (_read_file, os.path.join (gwz, n))
 			else:
-				data[ln] = z.read (n)
+				data[ln] = functools.partial (z.read, n)
 			if os.path.splitext (ln)[1] == os.extsep + 'lua':
 				assert code is None
 				code = ln
 		# There must be lua code.
 		assert code is not None
-		self.data = [data.pop (code)]
+		self.data = _Resources (None, 0)
+		self.data.append (data.pop (code) ())
 		# Set up external properties.
 		for key in ('gametype', 'author', 'description', 'guid', 'name', 'latitude', 'longitude', 'altitude', 'startdesc', 'url', 'device', 'version', 'user', 'completion_code'):
 			setattr (self, key, config[key])
@@ -194,7 +308,7 @@ class cartridge:
 		else:
 			self.iconId = 0
 		if config['splash'] is not None and config['splash'] in data:
-			self.splash = data.pop (config['splash'])
+			self.splash = data.pop (config['splash']) ()
 			if config['splash'] in data:
 				self.splashId = len (self.data)
 				self.data.append (data.pop (config['splash']))
@@ -209,7 +323,115 @@ class cartridge:
 			print 'ignoring unused media: %s.' % (', '.join (data.keys ()))
 		cartridge._setup (self, None)
 
+# Cartridge properties which are read from the lua source of gwz files by index.
+_LUA_KEYS = {'Name': 'name', 'Id': 'guid', 'Description': 'description', 'StartingLocationDescription': 'startdesc', 'Version': 'version', 'Author': 'author', 'TargetDevice': 'device', 'Activity': 'gametype'}
+_lua_cartridge_re = re.compile (r'(\w+)\s*=\s*Wherigo\.ZCartridge\s*\(')
+_lua_location_re = r'%s\.StartingLocation\s*=\s*(?:Wherigo\.)?ZonePoint\s*\(\s*([-+.\d]+)\s*,\s*([-+.\d]+)\s*,\s*(?:(?:Wherigo\.)?Distance\s*\(\s*)?([-+.\d]+)'
+_lua_property_re = r'''%s\.(\w+)\s*=\s*(?:"((?:[^"\\\n]|\\.)*)"|'((?:[^'\\\n]|\\.)*)'|\[(=*)\[(.*?)\]\4\])'''
+_lua_escape_re = re.compile (r'\\(\d{1,3}|x[0-9a-fA-F]{2}|.)', re.S)
+_LUA_ESCAPES = {'a': '\a', 'b': '\b', 'f': '\f', 'n': '\n', 'r': '\r', 't': '\t', 'v': '\v'}
+
+def _lua_unescape (s):
+	'''Decode the escape sequences in a lua string literal.  Unlike in python, \\ddd is decimal.'''
+	def replace (match):
+		e = match.group (1)
+		if e.isdigit ():
+			return chr (int (e)) if int (e) < 256 else match.group (0)
+		if len (e) == 3:
+			return chr (int (e[1:], 16))
+		return _LUA_ESCAPES.get (e, e)
+	return _lua_escape_re.sub (replace, s)
+
+class index:
+	'''Header and resource table of a cartridge, read without running its lua code.
+	For gwz files, the header is scanned from the lua source, so it can be incomplete.
+	resources is a list of (name, type, size) tuples; name is the id for gwc files and the file name for gwz files.
+	Use read (idx) to get the contents of resources[idx].'''
+	def __init__ (self, path, use_mmap = True):
+		self.path = path
+		for key in ('gametype', 'author', 'description', 'guid', 'name', 'latitude', 'longitude', 'altitude', 'startdesc', 'url', 'device', 'version', 'user', 'completion_code'):
+			setattr (self, key, None)
+		self.splashId = 0
+		self.iconId = 0
+		if os.path.isdir (path):
+			self._read_gwz (path, True)
+			return
+		file = _map (path) if use_mmap else open (path, 'rb').read ()
+		if file[:len (_CARTID)] == _CARTID:
+			self._read_gwc (file)
+		else:
+			if isinstance (file, mmap.mmap):
+				file.close ()
+			self._read_gwz (path, False)
+	def _read_gwc (self, file):
+		entries = list (_gwc_resources (file, _read_gwc_header (file, self)))
+		self.data = _Resources (file, len (entries))
+		self.resources = []
+		for idx, (rid, filetype, offset, size) in enumerate (entries):
+			self.data.set_ref (idx, offset, size)
+			self.resources.append ((rid, filetype, size))
+	def _read_gwz (self, gwz, isdir):
+		if isdir:
+			names = sorted (os.listdir (gwz))
+			self.resources = [(n, os.path.splitext (n)[1][1:].lower (), os.path.getsize (os.path.join (gwz, n))) for n in names]
+			self._open = lambda name: open (os.path.join (gwz, name), 'rb').read ()
+		else:
+			z = zipfile.ZipFile (gwz, 'r')
+			self.resources = [(i.filename, os.path.splitext (i.filename)[1][1:].lower (), i.file_size) for i in z.infolist ()]
+			self._open = z.read
+		self.data = None
+		for idx, resource in enumerate (self.resources):
+			if resource[1] == 'lua':
+				self._scan_lua (self.read (idx))
+				break
+	def _scan_lua (self, code):
+		cartridge = _lua_cartridge_re.search (code)
+		if cartridge is None:
+			return
+		var = re.escape (cartridge.group (1))
+		for match in re.finditer (_lua_property_re % var, code, re.S):
+			key = _LUA_KEYS.get (match.group (1))
+			if key is None:
+				continue
+			if match.group (5) is not None:
+				value = match.group (5)
+			else:
+				value = _lua_unescape (match.group (2) if match.group (2) is not None else match.group (3))
+			setattr (self, key, value)
+		location = re.search (_lua_location_re % var, code)
+		if location is not None:
+			self.latitude, self.longitude, self.altitude = [float (x) for x in location.groups ()]
+	def read (self, idx):
+		'''Get the contents of resources[idx].'''
+		if self.data is not None:
+			return self.data[idx]
+		return self._open (self.resources[idx][0])
+
+def open_index (path, use_mmap = True):
+	'''Read the metadata and resource table of a gwc or gwz file or gwz directory, without booting the lua interpreter.'''
+	return index (path, use_mmap)
+
+def _size (f):
+	'''Get the number of bytes that will be read from a resource, which is a string or a seekable file object.'''
+	if not hasattr (f, 'read'):
+		return len (f)
+	pos = f.tell ()
+	f.seek (0, os.SEEK_END)
+	ret = f.tell () - pos
+	f.seek (pos)
+	return ret
+
+def _copy (target, f):
+	'''Write a resource, which is a string or a file object, to target.'''
+	if hasattr (f, 'read'):
+		shutil.copyfileobj (f, target, 1 << 16)
+	else:
+		target.write (f)
+
 def write_cartridge (target, info, lua, files):
+	'''Write a gwc file.  The lua code and the files can be strings or seekable file objects.
+	File objects are copied to the target in chunks, so they are never completely in memory.'''
+	files = list (files)
 	if hasattr (info, 'splash'):
 		splashid = len (files)
 		files += (info.splash,)
@@ -242,20 +464,25 @@ def write_cartridge (target, info, lua, files):
 	header += _wstring (info.device)
 	header += '\0' * 4
 	header += _wstring (info.completion_code)
-	data = [_wint (len (lua)) + lua]
-	for f in files:
+	# Compute all offsets from the sizes, so the data can be written in one pass.
+	sizes = [_size (lua)] + [None if f is None else _size (f) for f in files]
+	table = []
+	offset = len (_CARTID) + 2 + 6 * len (sizes) + 4 + len (header)
+	for i, size in enumerate (sizes):
+		table.append (_wshort (i) + _wint (offset))
+		if i == 0:
+			offset += _INT.size + size
+		elif size is None:
+			offset += 1
+		else:
+			offset += 1 + _MEDIA.size + size
+	target.writelines ([_CARTID, _wshort (len (sizes))] + table + [_wint (len (header)), header])
+	target.write (_wint (sizes[0]))
+	_copy (target, lua)
+	for f, size in zip (files, sizes[1:]):
 		# TODO: Filetype is now always 0; it isn't used by my player, but can be used by other players.
 		if f is None:
-			data += ('\0',)
+			target.write ('\0')
 		else:
-			data += ('\1' + _wint (0) + _wint (len (f)) + f,)
-	target.write (_CARTID)
-	target.write (_wshort (len (data)))
-	offset = len (_CARTID) + 2 + 6 * len (data) + 4 + len (header)
-	for i in range (len (data)):
-		target.write (_wshort (i))
-		target.write (_wint (offset))
-		offset += len (data[i])
-	target.write (_wint (len (header)) + header)
-	for i in data:
-		target.write (i)
+			target.write ('\1' + _MEDIA.pack (0, size))
+			_copy (target, f)
@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+# preview.py - Draw pictures of cartridges without a display, for xmarksthespot
+# Copyright 2012 Bas Wijnen <wijnen@debian.org>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''Draw the zones, items and starting location of cartridges to png files.
+The map is drawn with cairo on an image surface, so no display is needed.'''
+
+import os
+import sys
+import argparse
+import traceback
+import cairo
+import wherigo
+import Map
+
+# The same defaults as the player uses.
+zonecolor = '#00c'
+itemcolor = '#880'
+startcolor = '#00f'
+
+class _Callbacks:
+	'''Callbacks for the lua code.  There is no user interface, so they do nothing.'''
+	def __getattr__ (self, name):
+		return lambda *a, **ka: None
+
+def load (filename):
+	'''Load a cartridge.  Its lua code is run, but OnStart is not called.'''
+	wherigo._cb = _Callbacks ()
+	config = {'Id': 0, 'URL': 'about:blank', 'Device': 'PocketPC', 'PlayerName': 'Preview', 'LogLevel': wherigo.LOGCARTRIDGE, 'env_Platform': 'xmarksthespot', 'env_CartFolder': os.path.dirname (os.path.abspath (filename)), 'env_SyncFolder': '/whatever', 'env_LogFolder': '/whatever', 'env_PathSep': '/', 'env_DeviceID': 'Python', 'env_Version': '2.11-compatible', 'env_Downloaded': '0', 'env_CartFilename': filename, 'env_Device': 'PocketPC'}
+	return wherigo._load (filename, config)
+
+def make_view (cartridge, size, zoom = None, mapname = None):
+	'''Make a Map.View showing the cartridge.  If zoom is None, everything is fit in the view.'''
+	view = Map.View (0, 0, size, zoom, 'cairo')
+	if mapname is not None:
+		view.add_layer (Map.MapLayer (view, mapname))
+	zones = view.add_layer (Map.MarkerLayer (view, zonecolor))
+	items = view.add_layer (Map.MarkerLayer (view, itemcolor))
+	start = view.add_layer (Map.MarkerLayer (view, startcolor))
+	for obj in cartridge.AllZObjects.list ():
+		if isinstance (obj, wherigo.Zone):
+			points = [(p.latitude, p.longitude) for p in obj.Points.list ()]
+			if len (points) > 0:
+				points.append (points[0])
+				zones.add_track ([points, [False, obj.Active and obj.Visible], obj])
+		elif isinstance (obj, wherigo.ZItem) and obj.Container is not wherigo.Player:
+			pos = obj._get_pos ()
+			if pos:
+				items.add_marker ([(pos.latitude, pos.longitude), [False, obj.Active and obj.Visible], obj])
+	loc = cartridge.StartingLocation
+	if loc and loc != wherigo.INVALID_ZONEPOINT:
+		start.add_marker ([(loc.latitude, loc.longitude), [True, True]])
+	if zoom is None and not view.fit ():
+		view.zoom = 100000.
+	return view
+
+def render (view, filename):
+	'''Draw a view to a png file.'''
+	surface = cairo.ImageSurface (cairo.FORMAT_RGB24, view.size[0], view.size[1])
+	cr = cairo.Context (surface)
+	cr.set_source_rgb (1, 1, 1)
+	cr.paint ()
+	view.draw_layers (surface)
+	surface.write_to_png (filename)
+
+def main ():
+	a = argparse.ArgumentParser (description = 'Draw png previews of wherigo cartridges')
+	a.add_argument ('cartridges', nargs = '+', help = 'cartridges to draw')
+	a.add_argument ('--output', default = None, help = 'output file for a single cartridge, or directory (default: next to the cartridges)')
+	a.add_argument ('--size', type = int, nargs = 2, default = (256, 256), metavar = ('WIDTH', 'HEIGHT'), help = 'size in pixels')
+	a.add_argument ('--zoom', type = float, default = None, help = 'pixels per degree (default: show everything)')
+	a.add_argument ('--map', default = None, help = 'map to use as background')
+	args = a.parse_args ()
+	ret = 0
+	for filename in args.cartridges:
+		if args.output is None:
+			target = os.path.splitext (filename)[0] + os.extsep + 'png'
+		elif os.path.isdir (args.output):
+			target = os.path.join (args.output, os.path.splitext (os.path.basename (filename))[0] + os.extsep + 'png')
+		else:
+			target = args.output
+		try:
+			render (make_view (load (filename), tuple (args.size), args.zoom, args.map), target)
+		except:
+			sys.stderr.write ('%s: %s\n' % (filename, traceback.format_exc ().strip ().split ('\n')[-1]))
+			ret = 1
+	return ret
+
+if __name__ == '__main__':
+	sys.exit (main ())
@@ -17,29 +17,254 @@
 # }}}
 
 # Imports {{{
+import sys
 import gtk
 import gui
+import gwc
 import wherigo
 import Map
 import time
 import re
+import glib
+import Queue
+import threading
 # }}}
 
 SIZE = gtk.ICON_SIZE_BUTTON
 
-def fill_cache (media): # {{{
-	if media._cache is not None:
-		return
-	for f in media._provider['File']:
+class Changes: # {{{
+	'''Remember which objects were changed, so views only need to refresh their rows for those objects.
+	install wraps __setattr__ of a class, so that writes to the watched attributes are recorded.'''
+	watch = ('Active', 'Visible', 'Container', 'Name', 'Icon', 'Complete', 'CorrectState')
+	# Attributes which the command index depends on.  Active and Visible only matter for objects in command_sources.
+	commands_watch = ('Commands', 'Enabled', 'CmdWith', 'WorksWithAll', 'WorksWithList', 'MakeReciprocal', 'Active', 'Visible')
+	def __init__ (self):
+		self.objects = {}
+		self.full = True
+		# Incremented for every write to commands_watch, so the command index knows when to be rebuilt.
+		self.commands_version = 0
+		# Ids of the objects which have commands, or None if that is not known.
+		self.command_sources = None
+	def install (self, cls):
+		original = getattr (cls, '__setattr__', None)
+		changes = self
+		def __setattr__ (obj, name, value):
+			if name in changes.commands_watch and (name not in ('Active', 'Visible') or changes.command_sources is None or id (obj) in changes.command_sources):
+				changes.commands_version += 1
+			if name in changes.watch:
+				changes.objects[id (obj)] = obj
+			if original is not None:
+				original (obj, name, value)
+			else:
+				obj.__dict__[name] = value
+		cls.__setattr__ = __setattr__
+	def reset (self):
+		'''Make all views rebuild completely, for example when a new cartridge is loaded.'''
+		self.objects = {}
+		self.full = True
+		self.commands_version += 1
+		self.command_sources = None
+	def take (self):
+		'''Get the changes since the previous call as (full rebuild needed, list of changed objects).'''
+		ret = (self.full, self.objects.values ())
+		self.objects = {}
+		self.full = False
+		return ret
+# The changes in the wherigo objects.
+changes = Changes ()
+# }}}
+
+class Commands: # {{{
+	'''Index of the commands which can be used with an item.
+	It is rebuilt when changes.commands_version has changed, so looking up the commands for the selection only costs the size of the answer.
+	Lua can change WorksWithList tables in place, which is not seen by changes; sync must be called after lua code has run.'''
+	def __init__ (self):
+		self.version = None
+		self.gameobject = None
+	def _build (self, gameobject):
+		self.version = changes.commands_version
+		self.gameobject = gameobject
+		self.items = []
+		# id (target) -> [(source, command name, command), ...]
+		self.reciprocal = {}
+		# (command, ids of its WorksWithList) for all commands in reciprocal.
+		self.lists = []
+		sources = set ()
+		for item in gameobject.AllZObjects.list ():
+			if isinstance (item, wherigo.ZItem):
+				self.items.append (item)
+			names = list (item.Commands) if hasattr (item, 'Commands') else []
+			if len (names) == 0:
+				continue
+			sources.add (id (item))
+			if not item.Visible or not item.Active:
+				continue
+			for c in names:
+				cmd = item.Commands[c]
+				if not cmd.Enabled or not cmd.CmdWith or cmd.WorksWithAll or not cmd.MakeReciprocal:
+					continue
+				targets = tuple (id (x) for x in cmd.WorksWithList.list ())
+				self.lists.append ((cmd, targets))
+				for target in set (targets):
+					self.reciprocal.setdefault (target, []).append ((item, c, cmd))
+		changes.command_sources = sources
+	def sync (self):
+		'''Rebuild the index if lua has changed the WorksWithList of one of the reciprocal commands.'''
+		if self.version != changes.commands_version:
+			# It will be rebuilt anyway.
+			return
+		for cmd, targets in self.lists:
+			if tuple (id (x) for x in cmd.WorksWithList.list ()) != targets:
+				self.version = None
+				return
+	def _check (self, gameobject):
+		if self.version != changes.commands_version or self.gameobject is not gameobject:
+			self._build (gameobject)
+	def all_items (self, gameobject):
+		'''All ZItems, the targets of commands which work with all.'''
+		self._check (gameobject)
+		return self.items
+	def reciprocals (self, gameobject, target):
+		'''The reciprocal commands of other objects which work with target, as (source, command name, command).'''
+		self._check (gameobject)
+		return self.reciprocal.get (id (target), ())
+# The index for the current cartridge.
+commands = Commands ()
+# }}}
+
+class Decoder: # {{{
+	'''Decode images in worker threads.
+	The data is read on the main thread, because the cartridge and the lua state are not thread safe;
+	only the PixbufLoader runs in the workers.  The results are handed back through the main loop.'''
+	def __init__ (self, workers = 2):
+		self.workers = workers
+		self.threads = []
+		self.jobs = Queue.Queue ()
+		# key -> list of callbacks which are waiting for it.
+		self.pending = {}
+	def request (self, key, names, size, cb):
+		'''Decode the first file of names which works.
+		Return False if the key was already requested; cb is called for it anyway.'''
+		if key in self.pending:
+			if cb is not None:
+				self.pending[key].append (cb)
+			return False
+		self.pending[key] = [] if cb is None else [cb]
+		if len (self.threads) < self.workers:
+			t = threading.Thread (target = self._run)
+			t.daemon = True
+			t.start ()
+			self.threads.append (t)
+		self._next (key, names, size)
+		return True
+	def _next (self, key, names, size):
+		'''Read the next file of names on the main thread and queue it for decoding.'''
+		while len (names) > 0:
+			try:
+				data = wherigo._wfzopen (names[0]).read ()
+			except:
+				print ('Not using %s: %s' % (names[0], sys.exc_info ()[1]))
+				names = names[1:]
+				continue
+			self.jobs.put ((key, names, data, size))
+			return False
+		self._done (key, None)
+		return False
+	def _run (self):
+		while True:
+			key, names, data, size = self.jobs.get ()
+			try:
+				ret = self.decode (data, size)
+			except:
+				print ('Not using %s: %s' % (names[0], sys.exc_info ()[1]))
+				# Try the next file; it must be read on the main thread.
+				glib.idle_add (self._next, key, names[1:], size)
+				continue
+			glib.idle_add (self._done, key, ret)
+	def _done (self, key, pixbuf):
+		if pixbuf is None:
+			# Remember the failure, so it is not retried for every request.
+			gwc.cache.put (key, False, 1)
+		else:
+			gwc.cache.put (key, pixbuf, pixbuf.get_rowstride () * pixbuf.get_height ())
+		for cb in self.pending.pop (key, ()):
+			cb (pixbuf)
+		return False
+	def decode (self, data, size):
+		'''Decode an image, scaled down while decoding to fit in size if that is not None.'''
 		pl = gtk.gdk.PixbufLoader ()
+		if size is not None:
+			def prepared (loader, w, h):
+				scale = min (float (size[0]) / w, float (size[1]) / h)
+				if scale < 1:
+					loader.set_size (max (1, int (w * scale)), max (1, int (h * scale)))
+			pl.connect ('size-prepared', prepared)
 		try:
-			pl.write (wherigo._wfzopen (f[0]).read ())
+			pl.write (data)
+		finally:
 			pl.close ()
-		except:
-			print ('Not using %s: %s' % (f[0], sys.exc_info ()[1]))
-			continue
-		media._cache = pl.get_pixbuf ()
-		return
+		return pl.get_pixbuf ()
+# }}}
+# The pool which decodes all images.
+decoder = Decoder ()
+
+def display_size (): # {{{
+	'''The largest size at which images are shown.'''
+	return (gtk.gdk.screen_width (), gtk.gdk.screen_height ())
+# }}}
+
+def fill_cache (media, size = None, cb = None): # {{{
+	'''Get the image for media as a Pixbuf, scaled down to fit in size if it is not None.
+	Decoded images are kept in the shared resource cache.  If the image is not in it, None is returned
+	and it is decoded in the background; when that is done, cb (pixbuf) is called from the main loop,
+	with None if the image cannot be loaded.'''
+	key = ('pixbuf', media, size)
+	ret = gwc.cache.get (key)
+	if ret is not None:
+		return ret or None
+	if key in decoder.pending:
+		decoder.request (key, None, size, cb)
+		return None
+	decoder.request (key, [f[0] for f in media._provider['File']], size, cb)
+	return None
+# }}}
+
+def prefetch (media): # {{{
+	'''Start decoding media for Details, so it is ready when it is shown.'''
+	if isinstance (media, wherigo.ZMedia):
+		fill_cache (media, display_size ())
+# }}}
+
+def thumbnail (media, state = None, widget = None, ready = None): # {{{
+	'''Get the list icon for media, or None.  If state is not None, the stock icon with that name (rendered for widget) is put in front of it.
+	Icons are kept in the shared resource cache; the key includes the media and the icon size, so they are made again when either changes.
+	While the media is being decoded, the icon is returned without it and ready () is called when it is done.'''
+	size = gtk.icon_size_lookup (SIZE)
+	key = ('icon', media, size, state)
+	ret = gwc.cache.get (key)
+	if ret is not None:
+		return ret
+	pending = False
+	if state is None:
+		if media is None:
+			return None
+		pixbuf = fill_cache (media, size, None if ready is None else lambda pixbuf: ready ())
+		if pixbuf is None:
+			return None
+		ret = pixbuf.scale_simple (size[0], size[1], gtk.gdk.INTERP_BILINEAR)
+	else:
+		orig = thumbnail (media, ready = ready)
+		pending = orig is None and media is not None and ('pixbuf', media, size) in decoder.pending
+		ret = widget.render_icon (state, SIZE)
+		if ret is not None and orig is not None:
+			icon = ret
+			ret = gtk.gdk.Pixbuf (gtk.gdk.COLORSPACE_RGB, True, 8, size[0] * 2, size[1])
+			ret.fill (0)
+			icon.copy_area (0, 0, size[0], size[1], ret, 0, 0)
+			orig.copy_area (0, 0, size[0], size[1], ret, size[0], 0)
+	if ret is None or pending:
+		return ret
+	return gwc.cache.put (key, ret, ret.get_rowstride () * ret.get_height ())
 # }}}
 
 class Book (gtk.Notebook): # {{{
@@ -89,6 +314,7 @@ class Details (gtk.VBox): # {{{
 		self.color = gui.gui.messagecolor
 		self.tabname = 'Message'
 		self.no_size = True
+		self.media = None
 		if cb:
 			gui.register_attribute ('set', None, self.set)
 		else:
@@ -103,17 +329,17 @@ class Details (gtk.VBox): # {{{
 		self.alt.hide ()
 	def set (self, (media, text, buttons, cb)):
 		# Media
+		self.media = media
 		if isinstance (media, wherigo.ZMedia):
-			fill_cache (media)
-			if media._cache is None:
+			# The alt text is shown until the image has been decoded, or if it cannot be.
+			pixbuf = fill_cache (media, display_size (), lambda pixbuf: self.media_ready (media, pixbuf))
+			if pixbuf is None:
 				self.alt.set_text (media.AltText)
 				self.alt.show ()
 				self.image.set_from_pixbuf (None)
 				self.scrolledwindow.hide ()
 			else:
-				self.image.set_from_pixbuf (media._cache)
-				self.scrolledwindow.show ()
-				self.alt.hide ()
+				self.media_ready (media, pixbuf)
 		else:
 			self.image.set_from_pixbuf (None)
 			self.scrolledwindow.hide ()
@@ -169,12 +395,20 @@ class Details (gtk.VBox): # {{{
 		self.show ()
 		if entry is not None:
 			entry.grab_focus ()
+	def media_ready (self, media, pixbuf):
+		if pixbuf is None or media is not self.media:
+			return
+		self.image.set_from_pixbuf (pixbuf)
+		self.scrolledwindow.show ()
+		self.alt.hide ()
 # }}}
 class List (gtk.VBox): # {{{
 	def __init__ (self, gui, title):# {{{
 		self.data = gui.data
 		gtk.VBox.__init__ (self)
 		self.store = gtk.ListStore (str, str, object, bool, bool, gtk.gdk.Pixbuf)
+		# id (object) -> [TreeIter, object, (name, active, visible, icon key)]
+		self.rows = {}
 		self.treeview = gtk.TreeView (self.store)
 		self.active_column = self.bool_column ('active', 3)
 		self.visible_column = self.bool_column ('visible', 4)
@@ -188,7 +422,8 @@ class List (gtk.VBox): # {{{
 		self.pack_start (self.details)
 		self.changed = gui.register_event ('changed')
 		gui.register_attribute ('select', None, self.select)
-		gui.register_attribute ('update', None, lambda x: self.update ())
+		# The value is True to rebuild the list, or a set of changed objects.
+		gui.register_attribute ('update', None, lambda x: self.update (None if x is True else x))
 		self.data = gui.data
 		self.show_all ()
 		if not self.data.debug:
@@ -220,16 +455,10 @@ class List (gtk.VBox): # {{{
 		ret.add_attribute (renderer, 'foreground', colidx)
 		return ret
 	# }}}
-	def _find (self, model, path, iter, data): # {{{
-		if model.get_value (iter, 2) == data[0]:
-			data[1] = iter
-			return True
-	# }}}
 	def select (self, item): # {{{
-		data = [item, None]
-		self.store.foreach (self._find, data)
-		if data[1] != None:
-			self.treeview.get_selection ().select_iter (data[1])
+		row = self.rows.get (id (item))
+		if row is not None:
+			self.treeview.get_selection ().select_iter (row[0])
 	# }}}
 	def selection_changed (self, selection): # {{{
 		'''Update details according to new selection.'''
@@ -251,7 +480,7 @@ class List (gtk.VBox): # {{{
 				# (commandname, pre-text, other-text, ((text, target), ...), source)
 				if cmd.CmdWith:
 					l = []
-					for k in [x for x in self.data.gameobject.AllZObjects.list () if isinstance (x, wherigo.ZItem) and x is not self.selected_item] if cmd.WorksWithAll else cmd.WorksWithList.list ():
+					for k in [x for x in commands.all_items (self.data.gameobject) if x is not self.selected_item] if cmd.WorksWithAll else cmd.WorksWithList.list ():
 						if k._is_visible (self.data.debug):
 							l.append ((k.Name, k))
 					if len (l) == 0:
@@ -260,14 +489,8 @@ class List (gtk.VBox): # {{{
 						buttons.append ((c, t, None, l, self.selected_item))
 				else:
 					buttons.append ((c, None, None, ((t, cmd),), self.selected_item))
-			for item in self.data.gameobject.AllZObjects.list ():
-				if not item.Visible or not item.Active or not hasattr (item, 'Commands'):
-					continue
-				for c in item.Commands:
-					cmd = item.Commands[c]
-					if not cmd.Enabled or not cmd.CmdWith or cmd.WorksWithAll or self.selected_item not in cmd.WorksWithList.list () or not cmd.MakeReciprocal:
-						continue
-					buttons.append ((c, None, None, (('%s: %s' % (item.Name, cmd.Text), self.selected_item),), item))
+			for item, c, cmd in commands.reciprocals (self.data.gameobject, self.selected_item):
+				buttons.append ((c, None, None, (('%s: %s' % (item.Name, cmd.Text), self.selected_item),), item))
 		else:
 			self.selected_item = None
 			media = None
@@ -279,47 +502,64 @@ class List (gtk.VBox): # {{{
 		self.details.set ((media, text, buttons, click))
 		self.changed ()
 	# }}}
-	def update (self): # {{{
-		keys, full = [], []
+	def update (self, items = None): # {{{
+		'''Refresh the rows for items, or rebuild the list if items is None.'''
+		if items is None or not self.data.gameobject:
+			self.rebuild ()
+			return
+		if len (items) == 0:
+			self.selection_changed (self.treeview.get_selection ())
+			return
+		for i in items:
+			if self.must_show (i):
+				self._write (i)
+			elif id (i) in self.rows:
+				self._remove (id (i))
+		self._updated ()
+	# }}}
+	def rebuild (self): # {{{
+		items = []
 		if self.data.gameobject:
-			for i in self.data.gameobject.AllZObjects.list ():
-				if self.must_show (i):
-					keys.append (i)
-					full.append ((i.Name, self.color, i, i.Active, i.Visible, None))
-		self.size = 0
-		# Step 1: remove all items that should not be present.
-		current = self.store.get_iter_first ()
-		while current:
-			next = self.store.iter_next (current)
-			k = self.store.get_value (current, 2)
-			if k in keys:
-				i = keys.index (k)
-				self.size += 1
-				keys.pop (i)
-				full.pop (i)
-			else:
-				self.store.remove (current)
-				self.remove_item (k)
-				self.new = True
-			current = next
-		# Step 2: add all missing items
-		for f in full:
-			self.size += 1
-			self.new = True
-			self.store.append (f)
-			self.add_item (f[2])
-		# Step 3: update the information
-		current = self.store.get_iter_first ()
-		while current:
-			i = self.store.get_value (current, 2)
-			self.store.set_value (current, 3, i.Active != 0)
-			self.store.set_value (current, 4, i.Visible != 0)
-			self.store.set_value (current, 5, self.make_icon (i))
-			current = self.store.iter_next (current)
+			items = [i for i in self.data.gameobject.AllZObjects.list () if self.must_show (i)]
+		# Remove all items that should not be present, then add or refresh the others.
+		keep = set (id (i) for i in items)
+		for key in [k for k in self.rows if k not in keep]:
+			self._remove (key)
+		for i in items:
+			self._write (i)
+		self._updated ()
+	# }}}
+	def _updated (self): # {{{
+		self.size = len (self.rows)
 		self.selection_changed (self.treeview.get_selection ())
 		self.get_parent ().update_title (self)
 		self.update_map ()
 	# }}}
+	def _write (self, item): # {{{
+		'''Add a row for item, or write the columns of its row which have changed.'''
+		values = (item.Name, item.Active != 0, item.Visible != 0, self.icon_key (item))
+		# The map holds a reference to the object, so its id cannot be reused while it is listed.
+		row = self.rows.get (id (item))
+		if row is None:
+			i = self.store.append ((values[0], self.color, item, values[1], values[2], self.make_icon (item)))
+			self.rows[id (item)] = [i, item, values]
+			self.add_item (item)
+			self.new = True
+			return
+		old = row[2]
+		for column, idx in ((0, 0), (3, 1), (4, 2)):
+			if values[idx] != old[idx]:
+				self.store.set_value (row[0], column, values[idx])
+		if values[3] != old[3]:
+			self.store.set_value (row[0], 5, self.make_icon (item))
+		row[2] = values
+	# }}}
+	def _remove (self, key): # {{{
+		row = self.rows.pop (key)
+		self.store.remove (row[0])
+		self.remove_item (row[1])
+		self.new = True
+	# }}}
 	def remove_item (self, item): # {{{
 		pass
 	# }}}
@@ -329,15 +569,19 @@ class List (gtk.VBox): # {{{
 	def update_map (self): # {{{
 		pass
 	# }}}
+	def icon_key (self, item): # {{{
+		'''Everything make_icon depends on; the icon is only made again when this changes.  Must be overridden with make_icon.'''
+		return item.Icon
+	# }}}
 	def make_icon (self, item): # {{{
 		'''Make Pixbuf icon for object.  Can be overridden.'''
-		if item.Icon is None:
-			return None
-		fill_cache (item.Icon)
-		if item.Icon._cache is None:
-			return None
-		size = gtk.icon_size_lookup (SIZE)
-		return item.Icon._cache.scale_simple (size[0], size[1], gtk.gdk.INTERP_BILINEAR)
+		return thumbnail (item.Icon, ready = lambda: self.icon_ready (item))
+	# }}}
+	def icon_ready (self, item): # {{{
+		'''Put the icon of item in its row, after its media has been decoded.'''
+		row = self.rows.get (id (item))
+		if row is not None and row[1] is item:
+			self.store.set_value (row[0], 5, self.make_icon (item))
 	# }}}
 # }}}
 class MarkerList (List): # {{{
@@ -382,6 +626,7 @@ class MarkerList (List): # {{{
 	# }}}
 	def selection_changed (self, selection): # {{{
 		'''Refresh selected status of markers on the map.'''
+		old = self.selected_item
 		if self.selected_item is not None and self.selected_item._id is not None:
 			layer = self.get_layer (self.selected_item)
 			if len (layer.markers) > self.selected_item._id:
@@ -395,12 +640,15 @@ class MarkerList (List): # {{{
 				layer.markers[self.selected_item._id][1][0] = True
 			if len (layer.tracks) > self.selected_item._id:
 				layer.tracks[self.selected_item._id][1][0] = True
+		if self.selected_item is not old:
+			for layer in self.layers:
+				layer.dirty = True
 		self.data.map.update ()
 	# }}}
 	def remove_item (self, item): # {{{
 		if item._id is not None:
 			layer = self.get_layer (item)
-			del layer.markers[item._id]
+			layer.remove_marker (item._id)
 			for check in layer.markers:
 				if check[2]._id > item._id:
 					check[2]._id -= 1
@@ -409,8 +657,7 @@ class MarkerList (List): # {{{
 		pos = item._get_pos ()
 		if pos:
 			layer = self.get_layer (item)
-			item._id = len (layer.markers)
-			layer.markers += ([(pos.latitude, pos.longitude), [False, item.Active and item.Visible], item],)
+			item._id = layer.add_marker ([(pos.latitude, pos.longitude), [False, item.Active and item.Visible], item])
 			self.data.map.update ()
 		else:
 			item._id = None
@@ -418,15 +665,16 @@ class MarkerList (List): # {{{
 	def update_map (self): # {{{
 		# Refresh all marker coordinates on the map.
 		for layer in self.layers:
-			for marker in layer.markers:
+			for i, marker in enumerate (layer.markers):
 				p = marker[2]._get_pos ()
-				marker[0] = (p.latitude, p.longitude)
+				layer.move_marker (i, (p.latitude, p.longitude))
 	# }}}
 	def _debug_update_map (self, item): # {{{
 		'Update active and visible status on map'
 		if item._id is not None:
 			layer = self.get_layer (item)
 			layer.markers[item._id][1][1] = item.Active and item.Visible
+			layer.changed ()
 	# }}}
 # }}}
 # }}}
@@ -450,19 +698,16 @@ class Locations (MarkerList): # {{{
 	def update_map (self):
 		# Add zone boundaries.
 		for layer in self.layers:
-			for track in layer.tracks:
-				track[0] = []
-				points = track[2].Points.list ()
-				for point in points:
-					track[0].append ((point.latitude, point.longitude))
+			for i, track in enumerate (layer.tracks):
+				points = [(point.latitude, point.longitude) for point in track[2].Points.list ()]
 				if len (points) > 0:
-					track[0].append ((points[0].latitude, points[0].longitude))
+					points.append (points[0])
+				layer.set_track (i, points)
 	def add_item (self, item): # {{{
 		pos = item._get_pos ()
 		if pos:
 			layer = self.get_layer (item)
-			item._id = len (layer.tracks)
-			layer.tracks += ([[(pos.latitude, pos.longitude)], [False, item.Active and item.Visible], item],)
+			item._id = layer.add_track ([[(pos.latitude, pos.longitude)], [False, item.Active and item.Visible], item])
 			self.data.map.update ()
 		else:
 			item._id = None
@@ -470,8 +715,8 @@ class Locations (MarkerList): # {{{
 	def remove_item (self, item): # {{{
 		if item._id is not None:
 			layer = self.get_layer (item)
-			del layer.tracks[item._id]
-			for check in layer.markers:
+			layer.remove_track (item._id)
+			for check in layer.tracks:
 				if check[2]._id > item._id:
 					check[2]._id -= 1
 	# }}}
@@ -514,22 +759,16 @@ class Tasks (List): # {{{
 		List.__init__ (self, gui, 'Task')
 	def must_show (self, item):
 		return isinstance (item, wherigo.ZTask) and (self.data.debug or (item.Active and item.Visible))
+	def icon_key (self, item):
+		return (item.Icon, item.Complete, item.CorrectState)
 	def make_icon (self, item):
-		orig = List.make_icon (self, item)
 		if not item.Complete:
-			state = self.render_icon (gtk.STOCK_EXECUTE, SIZE)
+			state = gtk.STOCK_EXECUTE
 		elif not item.CorrectState or item.CorrectState.lower () not in ('incorrect', 'notcorrect'):
-			state = self.render_icon (gtk.STOCK_APPLY, SIZE)
+			state = gtk.STOCK_APPLY
 		else:
-			state = self.render_icon (gtk.STOCK_CANCEL, SIZE)
-		if orig is None:
-			return state
-		size = gtk.icon_size_lookup (SIZE)
-		ret = gtk.gdk.Pixbuf (gtk.gdk.COLORSPACE_RGB, True, 8, size[0] * 2, size[1])
-		ret.fill (0)
-		state.copy_area (0, 0, size[0], size[1], ret, 0, 0)
-		orig.copy_area (0, 0, size[0], size[1], ret, size[0], 0)
-		return ret
+			state = gtk.STOCK_CANCEL
+		return thumbnail (item.Icon, state, self, lambda: self.icon_ready (item))
 widgets['Tasks'] = Tasks
 # }}}
 class History (gtk.VBox): # {{{
@@ -597,6 +836,8 @@ class Timers (gtk.TreeView): # {{{
 		self.colors = gui.get_attribute ('colors', default = '#f00,#0f0').split (',', 1)
 		signature = (str, str, bool, str, str, str, object)
 		self.store = gtk.ListStore (*signature)
+		# id (timer) -> [TreeIter, timer, values of columns 0 to 5]
+		self.rows = {}
 		gtk.TreeView.__init__ (self, self.store)
 		self.set_can_focus (False)
 		self.columns = [gtk.TreeViewColumn (x) for x in ('Name', 'Type', 'Running', 'Remaining', 'Duration')]
@@ -613,37 +854,23 @@ class Timers (gtk.TreeView): # {{{
 	def update (self):
 		if not self.data.gameobject:
 			return [], []
-		keys = []
-		full = []
-		for i in self.data.gameobject.AllZObjects.list ():
-			if isinstance (i, wherigo.ZTimer):
-				keys += (i.Name,)
-				full += ((i.Name, '', False, '', '', self.colors[0], i),) # Actual values are filled in below, in step 3.
-		# Step 1: remove all items that should not be present.
-		current = self.store.get_iter_first ()
-		while current:
-			next = self.store.iter_next (current)
-			k = self.store.get_value (current, 0)
-			if k not in keys:
-				self.store.remove (current)
-			else:
-				i = keys.index (k)
-				keys.pop (i)
-				full.pop (i)
-			current = next
-		# Step 2: add all missing items
-		for f in full:
-			self.store.append (f)
-		# Step 3: update contents.
-		current = self.store.get_iter_first ()
-		while current:
-			i = self.store.get_value (current, 6)
-			self.store.set_value (current, 1, i.Type)
-			self.store.set_value (current, 2, i._target is not None)
-			self.store.set_value (current, 5, self.colors[i._target is not None])
-			self.store.set_value (current, 3, int (i.Remaining))
-			self.store.set_value (current, 4, '%6.3f' % i.Duration)
-			current = self.store.iter_next (current)
+		timers = [i for i in self.data.gameobject.AllZObjects.list () if isinstance (i, wherigo.ZTimer)]
+		# Remove all timers that should not be present.
+		keep = set (id (i) for i in timers)
+		for key in [k for k in self.rows if k not in keep]:
+			self.store.remove (self.rows.pop (key)[0])
+		# Add new timers and write the columns which have changed.
+		for i in timers:
+			running = i._target is not None
+			values = (i.Name, i.Type, running, str (int (i.Remaining)), '%6.3f' % i.Duration, self.colors[running])
+			row = self.rows.get (id (i))
+			if row is None:
+				self.rows[id (i)] = [self.store.append (values + (i,)), i, values]
+				continue
+			for c in range (len (values)):
+				if values[c] != row[2][c]:
+					self.store.set_value (row[0], c, values[c])
+			row[2] = values
 	def skip (self):
 		'''Compute time which must be skipped ahead until next timeout'''
 		if not self.data.gameobject: